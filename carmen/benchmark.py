@@ -0,0 +1,370 @@
+""" Load test for server.py against a local fake llm and an in-process redis
+
+Simulated players play whole games through new_game -> get_clues -> get_destinations -> travel. The run reports
+latency percentiles per endpoint, requests/s and llm calls per game. Backend modes come from the same environment
+variables as the server, so two modes are compared by saving one run and passing it as the baseline of the next:
+
+    HOP_CONTENT_GENERATION=lazy python benchmark.py --players 50 --output lazy.json
+    HOP_CONTENT_GENERATION=batch python benchmark.py --players 50 --baseline lazy.json
+"""
+import os
+import re
+import ast
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import collections
+
+# Replies are parsed from the text by default since the fake model doesn't support tool calling, and games are
+# generated on demand so the pool refiller doesn't compete with the players
+os.environ.setdefault("STRUCTURED_OUTPUT", "json")
+os.environ.setdefault("GAME_POOL_DEPTH", "0")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+import httpx
+import redis
+import redis.asyncio
+import fakeredis
+import fakeredis.aioredis
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import carmen_backend
+import server
+
+# Backend settings recorded with every run so results from different modes can be told apart
+benchmark_settings = [
+    "ENGINE_MODE", "HOP_CONTENT_GENERATION", "GAME_STATE_STORAGE", "GAME_STATE_ENCODING", "GAME_POOL_DEPTH",
+    "STRUCTURED_OUTPUT", "STRUCTURED_OUTPUT_REASKS", "GENERATION_CACHE_VARIANTS", "CLUE_REWORDING",
+]
+
+_llm_calls = collections.Counter()
+_llm_calls_lock = threading.Lock()
+
+def _count_llm_call(kind: str):
+    with _llm_calls_lock:
+        _llm_calls[kind] += 1
+
+def _clues(locations: list, clue) -> dict:
+    return {"clues": [{"location": location, "clue": clue(location)} for location in locations]}
+
+def get_fake_reply(prompt: str, rng: random.Random) -> tuple:
+    """ Returns the kind of prompt and a well formed reply to it """
+    # Re-asks repeat the original prompt, the rejected answer after it could contain any of the phrases below
+    reask = "Your previous answer was:" in prompt
+    if reask:
+        prompt = prompt.split("Your previous answer was:")[0]
+
+    locations = rng.sample(carmen_backend.clue_locations, 3)
+    cities = carmen_backend.famous_cities
+
+    if "Reword each of the clues" in prompt:
+        kind = "reword_clues"
+        reply, _ = json.JSONDecoder().raw_decode(prompt[prompt.index('{"clues"'):])
+    elif "To start the game" in prompt:
+        kind = "new_game"
+        hops = rng.sample(cities, carmen_backend.MAX_HOPS + 1)
+        reply = {
+            "case_id": "00000000-0000-0000-0000-000000000000",
+            "suspect_name": "Benny the Benchmark",
+            "current_city": hops[0],
+            "stolen_item": f"The keys to {hops[0]}",
+            "hops": hops,
+            "next_hop": 1,
+        }
+    elif "travels through these cities in order" in prompt:
+        kind = "game_content"
+        hops = ast.literal_eval(re.search(r"in order: (\[.*?\])", prompt).group(1))
+        decoys = [city for city in cities if city not in hops]
+        # Clues are only asked for cities without facts
+        reply = {
+            "hops": [
+                {"city": city, "decoys": rng.sample(decoys, 4)} if carmen_backend.get_city_facts(city) is not None else
+                {"city": city, "clues": _clues(locations, lambda l: f"Seen near {city}")["clues"], "decoys": rng.sample(decoys, 4)}
+                for city in hops[1:]
+            ],
+            "arrest_clues": _clues(locations, lambda l: "Watch your step. You are getting close")["clues"],
+            "mistaken_clues": _clues(locations, lambda l: "No one with the suspect's description was seen here")["clues"],
+        }
+    elif "Generate a list of 4 cities" in prompt:
+        kind = "destinations"
+        match = re.search(r"must include (.*?), (.*?) \n.*?not include (.*?) or.*?cities in (.*?)\. Order", prompt, re.DOTALL)
+        required = [city for city in match.group(1, 2) if city]
+        # The exclude list is passed to the prompt either as a list or comma separated
+        excluded = required + [match.group(3)] + [city.strip(" []'\"") for city in match.group(4).split(",")]
+        others = [city for city in cities if city not in excluded]
+        reply = {"destinations": required + rng.sample(others, 4 - len(required))}
+    elif "Congratulations" in prompt:
+        kind = "arrest_clues"
+        reply = _clues(locations, lambda l: "Watch your step. You are getting close")
+    elif "No one with the suspect's description" in prompt:
+        kind = "mistaken_clues"
+        reply = _clues(locations, lambda l: "No one with the suspect's description was seen here")
+    elif "Now generate clues for" in prompt:
+        kind = "regular_clues"
+        city = re.search(r"Now generate clues for (.*)\n", prompt).group(1).strip()
+        reply = _clues(locations, lambda l: f"The suspect asked the {l.lower()} about {city}")
+    else:
+        raise Exception(f"The fake llm has no reply for this prompt: {prompt[:200]}")
+
+    return ("reask" if reask else kind), json.dumps(reply)
+
+class FakeChatModel(BaseChatModel):
+    """ Stands in for a provider's chat model, replying after latency seconds at tokens_per_second.
+
+    malformed_rate of the replies are cut in half so the re-ask path gets exercised too.
+    """
+    latency: float = 0.5
+    tokens_per_second: float = 100
+    malformed_rate: float = 0.05
+    rng: random.Random = random.Random(0)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _reply(self, messages) -> tuple:
+        prompt = messages[-1].content
+        kind, text = get_fake_reply(prompt, self.rng)
+        _count_llm_call(kind)
+
+        if self.rng.random() < self.malformed_rate:
+            text = text[:len(text) // 2]
+
+        usage = {"input_tokens": len(prompt) // 4 + 1, "output_tokens": len(text) // 4 + 1}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+
+        return text, usage
+
+    def _delays(self, text: str) -> tuple:
+        first_token = self.latency * self.rng.uniform(0.5, 1.5)
+        per_chunk = 4 / self.tokens_per_second if self.tokens_per_second else 0
+
+        return first_token, per_chunk
+
+    def _result(self, text: str, usage: dict) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text, usage = self._reply(messages)
+        first_token, per_chunk = self._delays(text)
+        time.sleep(first_token + per_chunk * len(text) / 16)
+
+        return self._result(text, usage)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text, usage = self._reply(messages)
+        first_token, per_chunk = self._delays(text)
+        await asyncio.sleep(first_token + per_chunk * len(text) / 16)
+
+        return self._result(text, usage)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        text, usage = self._reply(messages)
+        first_token, per_chunk = self._delays(text)
+        time.sleep(first_token)
+
+        # Chunks of 4 tokens, roughly 16 characters
+        for i in range(0, len(text), 16):
+            time.sleep(per_chunk)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[i:i + 16]))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        text, usage = self._reply(messages)
+        first_token, per_chunk = self._delays(text)
+        await asyncio.sleep(first_token)
+
+        for i in range(0, len(text), 16):
+            await asyncio.sleep(per_chunk)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[i:i + 16]))
+
+def use_fake_llm(latency: float, tokens_per_second: float, malformed_rate: float, seed: int = 0):
+    """ Makes every provider of the backend a FakeChatModel, keeping the metrics callbacks of the real ones """
+    rng = random.Random(seed)
+
+    @carmen_backend.functools.lru_cache(maxsize=None)
+    def get_fake_llm(provider, purpose):
+        callbacks = [carmen_backend.LLMMetricsHandler(provider, "fake")]
+        return FakeChatModel(latency=latency, tokens_per_second=tokens_per_second, malformed_rate=malformed_rate,
+                             rng=rng, callbacks=callbacks)
+
+    carmen_backend.get_llm = get_fake_llm
+    carmen_backend.get_structured_llm.cache_clear()
+
+def use_fake_redis():
+    """ Points the backend's redis connections at an in-process fakeredis server """
+    fake_server = fakeredis.FakeServer()
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=fake_server)
+    async_pools = {}
+
+    def get_redis_connection():
+        return carmen_backend.InstrumentedRedis(connection_pool=pool)
+
+    def get_async_redis_connection():
+        loop = asyncio.get_running_loop()
+        if loop not in async_pools:
+            async_pools[loop] = redis.asyncio.ConnectionPool(connection_class=fakeredis.aioredis.FakeAsyncRedisConnection, server=fake_server)
+
+        return carmen_backend.AsyncInstrumentedRedis(connection_pool=async_pools[loop])
+
+    carmen_backend.get_redis_connection = get_redis_connection
+    carmen_backend.get_async_redis_connection = get_async_redis_connection
+
+async def play_game(client: httpx.AsyncClient, rng: random.Random, wrong_city_rate: float, latencies: dict):
+    """ Plays one game to the arrest, traveling to a wrong city at wrong_city_rate of the hops """
+    async def request(method, path, **kwargs):
+        start = time.perf_counter()
+        response = await client.request(method, path, **kwargs)
+        latencies[path].append(time.perf_counter() - start)
+        response.raise_for_status()
+
+        return response.json()
+
+    case_id = (await request("POST", "/new_game"))["case_id"]
+
+    while True:
+        await request("GET", "/get_clues", params={"case_id": case_id})
+
+        # The player cheats by looking up the route so every game runs to the arrest
+        game_state = await carmen_backend.aget_game_state(case_id)
+        if game_state["next_hop"] > carmen_backend.MAX_HOPS:
+            return
+
+        destinations = (await request("GET", "/get_destinations", params={"case_id": case_id}))["destinations"]
+
+        next_city = game_state["hops"][game_state["next_hop"]]
+        wrong_cities = [city for city in destinations if city != next_city]
+        city = rng.choice(wrong_cities) if wrong_cities and rng.random() < wrong_city_rate else next_city
+
+        await request("POST", "/travel", json={"case_id": case_id, "city": city})
+
+def percentile(values: list, q: float) -> float:
+    """ Nearest rank percentile, q between 0 and 100 """
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(q / 100 * len(values) + 0.5)) - 1))
+
+    return values[index]
+
+def summarize(latencies: list) -> dict:
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+async def run_benchmark(players: int = 10, games: int = 2, wrong_city_rate: float = 0.2, latency: float = 0.5,
+                        tokens_per_second: float = 100, malformed_rate: float = 0.05, seed: int = 0) -> dict:
+    """ Has players concurrent players play games each and returns the report """
+    use_fake_redis()
+    use_fake_llm(latency, tokens_per_second, malformed_rate, seed)
+    _llm_calls.clear()
+    carmen_backend.metrics.clear()
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+
+    async def player(index):
+        rng = random.Random(seed * 1000 + index)
+        for _ in range(games):
+            try:
+                await play_game(client, rng, wrong_city_rate, latencies)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with server.lifespan(server.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            start = time.perf_counter()
+            await asyncio.gather(*[player(index) for index in range(players)])
+            duration = time.perf_counter() - start
+
+    requests = sum(len(values) for values in latencies.values())
+    finished = players * games - sum(errors.values())
+
+    return {
+        "settings": {name: getattr(carmen_backend, name) for name in benchmark_settings},
+        "load": {"players": players, "games": games, "wrong_city_rate": wrong_city_rate, "latency": latency,
+                 "tokens_per_second": tokens_per_second, "malformed_rate": malformed_rate, "seed": seed},
+        "duration_s": duration,
+        "games_finished": finished,
+        "errors": dict(errors),
+        "requests_per_second": requests / duration,
+        "llm_calls_per_game": sum(_llm_calls.values()) / max(finished, 1),
+        "llm_calls": dict(_llm_calls),
+        "endpoints": {path: summarize(values) for path, values in sorted(latencies.items())},
+        "all": summarize([value for values in latencies.values() for value in values]) if requests else None,
+    }
+
+def _change(value: float, baseline: float) -> str:
+    if not baseline:
+        return ""
+
+    return f" ({(value - baseline) / baseline * 100:+.1f}%)"
+
+def format_report(report: dict, baseline: dict = None) -> str:
+    baseline = baseline or {}
+    lines = [
+        "Settings: " + ", ".join(f"{name}={value}" for name, value in report["settings"].items()),
+        "Load: " + ", ".join(f"{name}={value}" for name, value in report["load"].items()),
+        "",
+        f"{'endpoint':<20}{'count':>8}{'p50 ms':>20}{'p95 ms':>20}{'p99 ms':>20}",
+    ]
+
+    rows = list(report["endpoints"].items()) + [("all", report["all"])]
+    baseline_rows = dict(baseline.get("endpoints", {}), all=baseline.get("all"))
+    for path, summary in rows:
+        if summary is None:
+            continue
+
+        base = baseline_rows.get(path) or {}
+        cells = [f"{summary[key]:.1f}{_change(summary[key], base.get(key))}" for key in ["p50_ms", "p95_ms", "p99_ms"]]
+        lines.append(f"{path:<20}{summary['count']:>8}" + "".join(f"{cell:>20}" for cell in cells))
+
+    lines += [
+        "",
+        f"Games finished: {report['games_finished']} in {report['duration_s']:.1f}s, errors: {report['errors'] or 'none'}",
+        f"Requests/s: {report['requests_per_second']:.1f}{_change(report['requests_per_second'], baseline.get('requests_per_second'))}",
+        f"LLM calls per game: {report['llm_calls_per_game']:.2f}{_change(report['llm_calls_per_game'], baseline.get('llm_calls_per_game'))} "
+        + json.dumps(report["llm_calls"]),
+    ]
+
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=10, help="Number of concurrent players")
+    parser.add_argument("--games", type=int, default=2, help="Games each player plays one after another")
+    parser.add_argument("--wrong-city-rate", type=float, default=0.2, help="Fraction of hops a player travels to a wrong city")
+    parser.add_argument("--latency", type=float, default=0.5, help="Mean seconds until the fake llm's first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100, help="Output rate of the fake llm, 0 for instant")
+    parser.add_argument("--malformed-rate", type=float, default=0.05, help="Fraction of fake llm replies that are malformed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save the report as json to this path")
+    parser.add_argument("--baseline", help="Report saved by an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    if carmen_backend.ENGINE_MODE != "rules":
+        raise Exception("The fake llm doesn't support tool calling, run the benchmark with ENGINE_MODE=rules")
+
+    report = asyncio.run(run_benchmark(args.players, args.games, args.wrong_city_rate, args.latency,
+                                       args.tokens_per_second, args.malformed_rate, args.seed))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(format_report(report, baseline))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,109 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: carmen.ipynb.
 
 # %% auto 0
-__all__ = ['OPENAI_API_KEY', 'ANTHROPIC_API_KEY', 'GROQ_API_KEY', 'models', 'model_provider', 'GAME_ENVIRONMENT', 'MAX_HOPS',
-           'famous_cities', 'clue_locations', 'python_repl', 'tools', 'get_llm', 'get_generation_llm', 'get_agent_llm',
-           'get_redis_host_port', 'get_dbid', 'get_redis_connection', 'get_game_states', 'clear_game_states',
-           'store_game_state', 'get_game_state', 'generate_new_game', 'new_game', 'fetch_game_state',
-           'set_current_city', 'update_game_state', 'generate_destinations', 'generate_regular_clues',
-           'generate_mistaken_clues', 'generate_arrest_clues', 'get_agent_executor', 'get_destinations', 'get_clues',
-           'travel']
+__all__ = ['OPENAI_API_KEY', 'ANTHROPIC_API_KEY', 'GROQ_API_KEY', 'models', 'model_prices', 'model_provider', 'ROUTER_PROVIDERS',
+           'ROUTER_WINDOW', 'ROUTER_MAX_ERROR_RATE', 'ROUTER_COOLDOWN', 'ROUTER_MAX_COOLDOWN', 'ROUTER_HEDGE',
+           'ROUTER_HEDGE_QUANTILE', 'ROUTER_HEDGE_DELAY', 'GAME_ENVIRONMENT', 'ENGINE_MODE', 'AGENT_EXECUTOR_MODE',
+           'AGENT_TOOL_WORKERS', 'PYTHON_EXECUTION', 'PYTHON_SANDBOX_WORKERS', 'PYTHON_SANDBOX_TIMEOUT',
+           'PYTHON_SANDBOX_CPU_SECONDS', 'PYTHON_SANDBOX_MEMORY_MB', 'MAX_HOPS', 'REDIS_MODE', 'REDIS_HOST',
+           'REDIS_PORT', 'REDIS_DB', 'REDIS_PASSWORD', 'REDIS_URL', 'REDIS_NODES', 'REDIS_SENTINEL_SERVICE',
+           'REDIS_MAX_CONNECTIONS', 'REDIS_SOCKET_TIMEOUT', 'REDIS_SOCKET_CONNECT_TIMEOUT',
+           'REDIS_HEALTH_CHECK_INTERVAL', 'GAME_STATE_STORAGE', 'GAME_KEY_PREFIX', 'GAME_STATE_ENCODING', 'GAME_TTL',
+           'GAME_FINISHED_TTL', 'GAME_ARCHIVE_PATH', 'GAME_POOL_DEPTH', 'GAME_POOL_REFILL_INTERVAL',
+           'GAME_POOL_REFILL_LOCK_TIMEOUT', 'GAME_POOL_PREFETCH_FIRST_HOP', 'HOP_CONTENT_GENERATION',
+           'GENERATION_CACHE_VARIANTS', 'GENERATION_CACHE_TTL', 'CITY_FACTS_PATH', 'CLUE_REWORDING',
+           'STRUCTURED_OUTPUT', 'STRUCTURED_OUTPUT_REASKS', 'logger', 'metrics', 'router', 'famous_cities',
+           'clue_locations', 'city_fact_fields', 'clue_templates', 'python_repl', 'tools', 'tool_metrics_handler',
+           'Metrics', 'start_request_spans', 'record_span', 'span', 'format_server_timing', 'get_token_usage',
+           'LLMMetricsHandler', 'ToolMetricsHandler', 'get_llm', 'get_generation_llm', 'get_agent_llm',
+           'get_router_providers', 'is_failover_error', 'ProviderRouter', 'RoutedLLM', 'retry', 'aretry', 'Clue',
+           'Clues', 'Destinations', 'GameState', 'TravelResult', 'HopContent', 'GameContent', 'CityFacts',
+           'get_output_text', 'parse_json_output', 'parse_structured_output', 'is_structured_output_error',
+           'get_structured_llm', 'get_reask_prompt', 'generate_json', 'agenerate_json', 'get_reformat_prompt',
+           'parse_agent_output', 'aparse_agent_output', 'get_redis_host_port', 'get_dbid', 'get_redis_nodes',
+           'InstrumentedPipeline', 'InstrumentedRedis', 'AsyncInstrumentedPipeline', 'AsyncInstrumentedRedis',
+           'InstrumentedRedisCluster', 'AsyncInstrumentedRedisCluster', 'get_redis_pool', 'get_redis_connection',
+           'close_redis_connections', 'get_async_redis_connection', 'aclose_redis_connections', 'get_city_indices',
+           'compact_game_state_fields', 'expand_game_state_fields', 'dump_game_state', 'load_game_state',
+           'get_game_key', 'iter_game_states', 'get_game_states', 'clear_game_states', 'store_game_state',
+           'get_game_state', 'get_game_ttl', 'is_finishing_update', 'archive_game_state', 'iter_archived_game_states',
+           'finish_game', 'update_game_state_fields', 'astore_game_state', 'aget_game_state',
+           'aupdate_game_state_fields', 'afinish_game', 'get_new_game_prompt', 'generate_new_game',
+           'agenerate_new_game', 'validate_game_state', 'get_game_pool_key', 'pop_pooled_game', 'apop_pooled_game',
+           'get_new_game_response', 'new_game', 'anew_game', 'ToolCache', 'cached_tool_call', 'invalidate_tool_cache',
+           'fetch_game_state', 'set_current_city', 'update_game_state', 'get_generation_cache_key', 'cached_generation',
+           'acached_generation', 'astream_generation', 'astream_cached_generation', 'JsonStreamParser',
+           'get_destinations_prompt', 'generate_destinations', 'agenerate_destinations', 'get_city_facts_prompt',
+           'validate_city_facts', 'generate_city_facts', 'build_city_facts', 'load_city_facts', 'get_city_facts',
+           'generate_clues_from_facts', 'get_reword_clues_prompt', 'reword_clues', 'areword_clues',
+           'get_regular_clues_prompt', 'generate_regular_clues', 'agenerate_regular_clues', 'get_mistaken_clues_prompt',
+           'generate_mistaken_clues', 'agenerate_mistaken_clues', 'get_arrest_clues_prompt', 'generate_arrest_clues',
+           'agenerate_arrest_clues', 'get_next_city', 'get_previous_city', 'get_exclude_list', 'get_clue_type',
+           'get_travel_update', 'repair_destinations', 'get_hop_content', 'generate_hop_content',
+           'agenerate_hop_content', 'get_game_content_prompt', 'build_batched_hop_content', 'generate_game_content',
+           'agenerate_game_content', 'generate_pooled_game', 'refill_game_pool', 'start_game_pool_refiller',
+           'get_sandbox_prelude', 'PythonSandbox', 'get_python_sandbox', 'run_python', 'get_tool_executor',
+           'ToolBarrier', 'ParallelAgentExecutor', 'get_agent_executor', 'invoke_agent', 'ainvoke_agent',
+           'get_destinations_agent_prompt', 'get_destinations_with_agent', 'aget_destinations_with_agent',
+           'get_destinations_args', 'get_destinations_response', 'get_destinations_with_rules',
+           'aget_destinations_with_rules', 'get_destinations', 'aget_destinations', 'get_clues_agent_prompt',
+           'get_clues_with_agent', 'aget_clues_with_agent', 'get_clues_with_rules', 'aget_clues_with_rules',
+           'get_clues', 'aget_clues', 'get_travel_agent_prompt', 'travel_with_agent', 'atravel_with_agent',
+           'travel_with_rules', 'atravel_with_rules', 'travel', 'atravel', 'astream_new_game', 'astream_clues']
 
 # %% carmen.ipynb 2
 import os
 import json
+import time
+import uuid
+import random
+import logging
+import asyncio
+import threading
+import functools
+import weakref
+import hashlib
+import contextvars
+import contextlib
+import collections
+import statistics
+import concurrent.futures
+import gzip
+import queue
+import sys
+import select
+import inspect
+import subprocess
+import re
+import ast
+from typing import List, Optional
 
 import redis
+import redis.asyncio
+import redis.cluster
+import redis.sentinel
+import redis.asyncio.cluster
+import redis.asyncio.sentinel
+
+from pydantic import BaseModel, Field
 
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 from langchain_groq import ChatGroq
 
-from retrying import retry
+import retrying
 
-from langchain_core.tools import tool
+from langchain_core.tools import tool, ToolException
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain.agents import Tool
 from langchain_experimental.utilities import PythonREPL
 
 from langchain_core.prompts import ChatPromptTemplate
 from langchain.agents import create_tool_calling_agent
 from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentAction
+
+import python_sandbox
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
@@ -48,41 +124,794 @@ models = {
     }
 }
 
+# USD per million input and output tokens of each model above, used for the cost counters
+model_prices = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4": (30, 60),
+    "claude-3-sonnet-20240229": (3, 15),
+    "claude-3-opus-20240229": (15, 75),
+    "llama3-8b-8192": (0.05, 0.08),
+    "mixtral-8x7b-32768": (0.24, 0.24),
+}
+
 model_provider = os.getenv("MODEL_PROVIDER", "openai")
 
+# Providers generation calls are routed between, in order of preference. Defaults to only MODEL_PROVIDER, listing more
+# (e.g. "openai,anthropic,groq") opts into failover and hedging across them
+ROUTER_PROVIDERS = [provider.strip() for provider in os.getenv("ROUTER_PROVIDERS", "").split(",") if provider.strip()]
+# Only calls made in the last ROUTER_WINDOW seconds count towards a provider's latency and error rate
+ROUTER_WINDOW = float(os.getenv("ROUTER_WINDOW", "300"))
+# Providers failing more than this share of recent calls are only used once the others have failed
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.5"))
+# Seconds a provider is skipped after a rate limit, server error or timeout, doubling with each consecutive failure
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "10"))
+ROUTER_MAX_COOLDOWN = float(os.getenv("ROUTER_MAX_COOLDOWN", "300"))
+# Send async generation calls to a second provider as well when the first hasn't answered within its p95 latency
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "false").lower() == "true"
+ROUTER_HEDGE_QUANTILE = 0.95
+# Hedge delay used until a provider has enough recent calls to estimate its p95
+ROUTER_HEDGE_DELAY = float(os.getenv("ROUTER_HEDGE_DELAY", "5"))
+
 GAME_ENVIRONMENT = os.getenv("GAME_ENVIRONMENT", "DEV")
 
+# "rules" computes hops, clue types and travel in python, "agent" delegates them to the agent
+ENGINE_MODE = os.getenv("ENGINE_MODE", "rules")
+
+# "parallel" runs the tool calls from one agent turn concurrently, "sequential" runs them one after another
+AGENT_EXECUTOR_MODE = os.getenv("AGENT_EXECUTOR_MODE", "parallel")
+AGENT_TOOL_WORKERS = int(os.getenv("AGENT_TOOL_WORKERS", "8"))
+
+# "sandbox" runs agent written python in a pool of isolated worker processes (see python_sandbox.py), "inprocess" uses
+# PythonREPL in the server process
+PYTHON_EXECUTION = os.getenv("PYTHON_EXECUTION", "sandbox")
+PYTHON_SANDBOX_WORKERS = int(os.getenv("PYTHON_SANDBOX_WORKERS", "4"))
+# Wall clock seconds a snippet may run before its worker is killed and replaced
+PYTHON_SANDBOX_TIMEOUT = float(os.getenv("PYTHON_SANDBOX_TIMEOUT", "5"))
+PYTHON_SANDBOX_CPU_SECONDS = int(os.getenv("PYTHON_SANDBOX_CPU_SECONDS", "2"))
+PYTHON_SANDBOX_MEMORY_MB = int(os.getenv("PYTHON_SANDBOX_MEMORY_MB", "256"))
+
 MAX_HOPS = 5
 
+# "standalone" connects to REDIS_HOST:REDIS_PORT (or REDIS_URL), "sentinel" asks the sentinels in REDIS_NODES for the
+# master of REDIS_SENTINEL_SERVICE and "cluster" uses REDIS_NODES (or REDIS_URL) as the cluster's startup nodes
+REDIS_MODE = os.getenv("REDIS_MODE", "standalone")
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# Defaults to a db per GAME_ENVIRONMENT, clusters only have db 0
+REDIS_DB = os.getenv("REDIS_DB")
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD") or None
+# redis:// or rediss:// url that takes precedence over REDIS_HOST, REDIS_PORT, REDIS_DB and REDIS_PASSWORD
+REDIS_URL = os.getenv("REDIS_URL", "")
+# Comma separated host:port list of the sentinels or the cluster startup nodes
+REDIS_NODES = os.getenv("REDIS_NODES", "")
+REDIS_SENTINEL_SERVICE = os.getenv("REDIS_SENTINEL_SERVICE", "mymaster")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "5"))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+
+# "hash" stores each game as a redis hash with a json encoded value per field, so an update is a single atomic script
+# call. "json" stores it as a single json string and updates it with an optimistic WATCH/GET/MULTI transaction, which
+# takes three round trips. Games stored with one setting can't be read with the other.
+GAME_STATE_STORAGE = os.getenv("GAME_STATE_STORAGE", "hash")
+
+# Game keys are namespaced so that scans don't have to touch unrelated keys in the same db
+GAME_KEY_PREFIX = os.getenv("GAME_KEY_PREFIX", "carmen:game:")
+
+# "compact" stores the cities of a game as indices into famous_cities, "plain" stores them by name
+GAME_STATE_ENCODING = os.getenv("GAME_STATE_ENCODING", "compact")
+# Seconds an idle game is kept in redis, every write to the game restarts it, 0 keeps games forever
+GAME_TTL = int(os.getenv("GAME_TTL", str(24 * 60 * 60)))
+# Seconds a game stays in redis after the arrest so the arrest clues can still be fetched, 0 keeps it for GAME_TTL
+GAME_FINISHED_TTL = int(os.getenv("GAME_FINISHED_TTL", "600"))
+# Finished games are appended to this gzip compressed json lines file. Archival is off unless it is set, the file grows
+# without bound and every server worker appends to it, so point it at a data directory (e.g. /var/lib/carmen/games.jsonl.gz)
+GAME_ARCHIVE_PATH = os.getenv("GAME_ARCHIVE_PATH", "")
+
+# Number of pre-generated games to keep in redis per model provider, 0 disables the pool
+GAME_POOL_DEPTH = int(os.getenv("GAME_POOL_DEPTH", "10"))
+GAME_POOL_REFILL_INTERVAL = float(os.getenv("GAME_POOL_REFILL_INTERVAL", "5"))
+# Seconds the refill lock is held for without a game being added before another worker may take over
+GAME_POOL_REFILL_LOCK_TIMEOUT = float(os.getenv("GAME_POOL_REFILL_LOCK_TIMEOUT", "120"))
+# Pre-generate the clues and destinations for the first hop of pooled games
+GAME_POOL_PREFETCH_FIRST_HOP = os.getenv("GAME_POOL_PREFETCH_FIRST_HOP", "true").lower() == "true"
+
+# "lazy" generates the clues and destinations for a hop when the player gets there, "batch" generates them for every
+# hop in a single request when the game is created and "parallel" does so with concurrent requests per hop
+HOP_CONTENT_GENERATION = os.getenv("HOP_CONTENT_GENERATION", "lazy")
+
+# Generated clues and destinations are cached per tool and arguments, keeping a few variants so games still vary
+GENERATION_CACHE_VARIANTS = int(os.getenv("GENERATION_CACHE_VARIANTS", "5"))
+GENERATION_CACHE_TTL = int(os.getenv("GENERATION_CACHE_TTL", str(7 * 24 * 60 * 60)))
+
+# Per-city facts built offline with build_city_facts(), regular clues are sampled from it. The default is next to this
+# module so it is found whatever directory the server is started from (the notebook has no __file__ and uses its own)
+CITY_FACTS_PATH = os.getenv(
+    "CITY_FACTS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(globals().get("__file__", "carmen.ipynb"))), "city_facts.json"),
+)
+# Have the generation llm reword clues built from the city facts
+CLUE_REWORDING = os.getenv("CLUE_REWORDING", "false").lower() == "true"
+
+# "native" asks the provider for replies matching a schema (tool calling), "json" parses and validates the text reply
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "native")
+# Number of times a malformed reply is sent back to the model along with the error before giving up
+STRUCTURED_OUTPUT_REASKS = int(os.getenv("STRUCTURED_OUTPUT_REASKS", "2"))
+
+logger = logging.getLogger("carmen")
+
 # %% carmen.ipynb 3
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+class Metrics:
+    """ Thread safe counters and latency histograms, rendered in the prometheus text format """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, metric: str, value: float = 1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, metric: str, value: float, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def get(self, metric: str, **labels) -> float:
+        return self.counters.get((metric, tuple(sorted(labels.items()))), 0)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (_, labels), value in sorted(item for item in self.counters.items() if item[0][0] == name):
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (_, labels), histogram in sorted(item for item in self.histograms.items() if item[0][0] == name):
+                    for bound, count in zip(self.buckets, histogram["buckets"]):
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {count}")
+
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Spans recorded while serving one request, set by the server so it can add timing headers to the response
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+def start_request_spans() -> list:
+    spans = []
+    _request_spans.set(spans)
+
+    return spans
+
+def record_span(kind: str, name: str, duration: float, status: str = "ok"):
+    metrics.observe("carmen_span_seconds", duration, kind=kind, name=name, status=status)
+
+    spans = _request_spans.get()
+    if spans is not None:
+        spans.append((kind, name, duration))
+
+@contextlib.contextmanager
+def span(kind: str, name: str):
+    """ Times the enclosed block as a span of the given kind, e.g. redis, llm, tool, agent or attempt """
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        record_span(kind, name, time.perf_counter() - start, status)
+
+def format_server_timing(spans: list, total: float) -> str:
+    """ Sums the spans of a request per kind into a Server-Timing header value """
+    kinds = {}
+    for kind, _, duration in spans:
+        count, kind_total = kinds.get(kind, (0, 0.0))
+        kinds[kind] = (count + 1, kind_total + duration)
+
+    entries = [f'{kind};dur={kind_total * 1000:.1f};desc="{count} calls"' for kind, (count, kind_total) in kinds.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+
+    return ", ".join(entries)
+
+def get_token_usage(response) -> tuple:
+    """ Returns the input and output token counts of an LLMResult """
+    input_tokens, output_tokens = 0, 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+            input_tokens += usage.get("input_tokens", 0)
+            output_tokens += usage.get("output_tokens", 0)
+
+    if input_tokens == 0 and output_tokens == 0:
+        llm_output = response.llm_output or {}
+        usage = llm_output.get("token_usage") or llm_output.get("usage") or {}
+        input_tokens = usage.get("prompt_tokens", usage.get("input_tokens", 0))
+        output_tokens = usage.get("completion_tokens", usage.get("output_tokens", 0))
+
+    return input_tokens, output_tokens
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """ Records a span and the token and cost counters for every call to a model """
+    run_inline = True
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.starts = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.starts[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self.starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id, "ok")
+
+        input_tokens, output_tokens = get_token_usage(response)
+        input_price, output_price = model_prices.get(self.model, (0, 0))
+        metrics.inc("carmen_llm_tokens_total", input_tokens, provider=self.provider, model=self.model, type="input")
+        metrics.inc("carmen_llm_tokens_total", output_tokens, provider=self.provider, model=self.model, type="output")
+        metrics.inc("carmen_llm_cost_usd_total", (input_tokens * input_price + output_tokens * output_price) / 1e6,
+                    provider=self.provider, model=self.model)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, "error")
+
+    def _end(self, run_id, status: str):
+        start = self.starts.pop(run_id, None)
+        if start is not None:
+            record_span("llm", f"{self.provider}:{self.model}", time.perf_counter() - start, status)
+
+class ToolMetricsHandler(BaseCallbackHandler):
+    """ Records a span for every tool call, whether the agent or the rules engine made it """
+    run_inline = True
+
+    def __init__(self):
+        self.starts = {}
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self.starts[run_id] = (serialized.get("name", "tool"), time.perf_counter())
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id, "ok")
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, "error")
+
+    def _end(self, run_id, status: str):
+        name, start = self.starts.pop(run_id, (None, None))
+        if start is not None:
+            record_span("tool", name, time.perf_counter() - start, status)
+
+# %% carmen.ipynb 5
+# Clients are cached per process so their HTTP connections and TLS sessions are reused across requests
+@functools.lru_cache(maxsize=None)
 def get_llm(provider, purpose):
     model = models[provider][purpose]
     
-    if model_provider == "openai":
-        return ChatOpenAI(api_key=OPENAI_API_KEY, model=model)
-    elif model_provider == "anthropic":
-        return ChatAnthropic(api_key=ANTHROPIC_API_KEY, model=model)
-    elif model_provider == "groq":
-        return ChatGroq(groq_api_key=GROQ_API_KEY, temperature=0, model_name=model)
+    callbacks = [LLMMetricsHandler(provider, model)]
+
+    if provider == "openai":
+        return ChatOpenAI(api_key=OPENAI_API_KEY, model=model, callbacks=callbacks)
+    elif provider == "anthropic":
+        return ChatAnthropic(api_key=ANTHROPIC_API_KEY, model=model, callbacks=callbacks)
+    elif provider == "groq":
+        return ChatGroq(groq_api_key=GROQ_API_KEY, temperature=0, model_name=model, callbacks=callbacks)
     else:
-        raise Exception(f"Unknown model provider: {model_provider}")
+        raise Exception(f"Unknown model provider: {provider}")
         
 def get_generation_llm():
-    return get_llm(model_provider, "generation")
+    # Generation calls are routed between providers, the agent stays on model_provider
+    return RoutedLLM("generation")
 
 def get_agent_llm():
     return get_llm(model_provider, "agent")
 
-# %% carmen.ipynb 4
+# %% carmen.ipynb 6
+def get_router_providers() -> list:
+    # Having api keys for other providers is not enough, routing to them has to be asked for
+    return ROUTER_PROVIDERS or [model_provider]
+
+def is_failover_error(e: Exception) -> bool:
+    """ Rate limits, server errors, timeouts and connection errors are worth retrying on another provider """
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status in (408, 429) or status >= 500
+
+    name = type(e).__name__.lower()
+    return isinstance(e, (TimeoutError, ConnectionError)) or "timeout" in name or "connection" in name
+
+class ProviderRouter:
+    """ Rolling latency and error rates per provider and purpose, used to order the providers for each call """
+    def __init__(self, window: float = None, max_samples: int = 200):
+        self.window = window
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.failures = {}
+        self.cooldowns = {}
+
+    def _recent(self, provider: str, purpose: str, now: float) -> list:
+        window = ROUTER_WINDOW if self.window is None else self.window
+        return [sample for sample in self.samples.get((provider, purpose), ()) if now - sample[0] <= window]
+
+    def record(self, provider: str, purpose: str, latency: float = None, ok: bool = True):
+        key = (provider, purpose)
+        with self.lock:
+            self.samples.setdefault(key, collections.deque(maxlen=self.max_samples)).append((time.monotonic(), latency, ok))
+            if ok:
+                self.failures[key] = 0
+
+    def record_failure(self, provider: str, purpose: str, e: Exception):
+        # Other errors, like bad requests, say nothing about the provider's health
+        if not is_failover_error(e):
+            return
+
+        key = (provider, purpose)
+        self.record(provider, purpose, ok=False)
+
+        with self.lock:
+            self.failures[key] = self.failures.get(key, 0) + 1
+            cooldown = min(ROUTER_COOLDOWN * 2 ** (self.failures[key] - 1), ROUTER_MAX_COOLDOWN)
+            self.cooldowns[key] = time.monotonic() + cooldown
+
+        metrics.inc("carmen_llm_failovers_total", provider=provider, purpose=purpose)
+        logger.warning(f"{provider} {purpose} call failed, skipping it for {cooldown:.0f}s: {e}")
+
+    def latency(self, provider: str, purpose: str, quantile: float = 0.5, min_samples: int = 1, now: float = None):
+        """ Returns the given quantile of recent successful call latencies, None without min_samples of them """
+        recent = self._recent(provider, purpose, now or time.monotonic())
+        latencies = [latency for _, latency, ok in recent if ok and latency is not None]
+        if not latencies or len(latencies) < min_samples:
+            return None
+        if len(latencies) == 1:
+            return latencies[0]
+
+        return statistics.quantiles(latencies, n=100, method="inclusive")[round(quantile * 100) - 1]
+
+    def error_rate(self, provider: str, purpose: str, now: float = None) -> float:
+        recent = self._recent(provider, purpose, now or time.monotonic())
+        if not recent:
+            return 0.0
+
+        return sum(1 for _, _, ok in recent if not ok) / len(recent)
+
+    def rank(self, purpose: str, providers: list = None) -> list:
+        """ Healthy providers by median latency, then degraded ones, and providers cooling down only as a last resort.
+
+        Providers without recent calls go after the measured healthy ones in the order they are listed, so live traffic
+        only reaches them on failover (or when nothing has been measured yet).
+        """
+        providers = providers or get_router_providers()
+        now = time.monotonic()
+
+        def key(provider):
+            cooling = self.cooldowns.get((provider, purpose), 0) > now
+            degraded = self.error_rate(provider, purpose, now) > ROUTER_MAX_ERROR_RATE
+            latency = self.latency(provider, purpose, now=now)
+
+            return (cooling, degraded, latency is None, latency or 0.0, providers.index(provider))
+
+        return sorted(providers, key=key)
+
+    def hedge_delay(self, provider: str, purpose: str) -> float:
+        latency = self.latency(provider, purpose, ROUTER_HEDGE_QUANTILE, min_samples=20)
+        return ROUTER_HEDGE_DELAY if latency is None else latency
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.failures.clear()
+            self.cooldowns.clear()
+
+router = ProviderRouter()
+
+class RoutedLLM:
+    """ Sends each call to the best ranked provider for purpose, failing over to the next one on transient errors """
+    def __init__(self, purpose: str, schema=None):
+        self.purpose = purpose
+        self.schema = schema
+
+    def with_structured_output(self, schema):
+        return RoutedLLM(self.purpose, schema)
+
+    def _runnable(self, provider: str):
+        if self.schema is None:
+            return get_llm(provider, self.purpose)
+
+        return get_structured_llm(provider, self.purpose, self.schema)
+
+    def _call(self, provider: str, prompt):
+        start = time.perf_counter()
+        try:
+            result = self._runnable(provider).invoke(prompt)
+        except Exception as e:
+            router.record_failure(provider, self.purpose, e)
+            raise
+
+        router.record(provider, self.purpose, time.perf_counter() - start)
+        return result
+
+    async def _acall(self, provider: str, prompt):
+        start = time.perf_counter()
+        try:
+            result = await self._runnable(provider).ainvoke(prompt)
+        except asyncio.CancelledError:
+            # A cancelled hedge didn't finish, so its time says nothing about the provider's latency or health
+            raise
+        except Exception as e:
+            router.record_failure(provider, self.purpose, e)
+            raise
+
+        router.record(provider, self.purpose, time.perf_counter() - start)
+        return result
+
+    async def _ahedged(self, provider: str, hedge: str, prompt):
+        """ Starts the hedge when provider is slower than its p95 or fails, and returns the first answer """
+        tasks = {asyncio.ensure_future(self._acall(provider, prompt))}
+        done, _ = await asyncio.wait(tasks, timeout=router.hedge_delay(provider, self.purpose))
+        if done and (next(iter(done)).exception() is None or not is_failover_error(next(iter(done)).exception())):
+            return next(iter(done)).result()
+
+        metrics.inc("carmen_llm_hedges_total", provider=hedge, purpose=self.purpose)
+        tasks = {task for task in tasks if not task.done()} | {asyncio.ensure_future(self._acall(hedge, prompt))}
+        error = next(iter(done)).exception() if done else None
+
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+
+                    error = task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        raise error
+
+    def invoke(self, prompt):
+        error = None
+        for provider in router.rank(self.purpose):
+            try:
+                return self._call(provider, prompt)
+            except Exception as e:
+                if not is_failover_error(e):
+                    raise
+
+                error = e
+
+        raise error
+
+    async def ainvoke(self, prompt):
+        providers = router.rank(self.purpose)
+        error = None
+
+        while providers:
+            provider = providers.pop(0)
+            hedge = providers.pop(0) if ROUTER_HEDGE and providers else None
+            try:
+                if hedge is None:
+                    return await self._acall(provider, prompt)
+
+                return await self._ahedged(provider, hedge, prompt)
+            except Exception as e:
+                if not is_failover_error(e):
+                    raise
+
+                error = e
+
+        raise error
+
+    async def astream(self, prompt):
+        """ Fails over only until the first chunk has been streamed """
+        error = None
+        for provider in router.rank(self.purpose):
+            start = time.perf_counter()
+            streamed = False
+            try:
+                async for chunk in self._runnable(provider).astream(prompt):
+                    streamed = True
+                    yield chunk
+            except Exception as e:
+                router.record_failure(provider, self.purpose, e)
+                if streamed or not is_failover_error(e):
+                    raise
+
+                error = e
+                continue
+
+            router.record(provider, self.purpose, time.perf_counter() - start)
+            return
+
+        raise error
+
+# %% carmen.ipynb 8
+def retry(stop_max_delay, stop_max_attempt_number):
+    """ retrying's @retry with a span around each attempt so retries show up in the metrics """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def attempt(*args, **kwargs):
+            with span("attempt", fn.__name__):
+                return fn(*args, **kwargs)
+
+        return retrying.retry(stop_max_delay=stop_max_delay, stop_max_attempt_number=stop_max_attempt_number)(attempt)
+
+    return decorator
+
+def aretry(stop_max_delay, stop_max_attempt_number):
+    """ Retries a coroutine with the same stop conditions as retrying's @retry """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            attempt = 1
+
+            while True:
+                try:
+                    with span("attempt", fn.__name__):
+                        return await fn(*args, **kwargs)
+                except Exception:
+                    elapsed = (time.monotonic() - start) * 1000
+                    if attempt >= stop_max_attempt_number or elapsed >= stop_max_delay:
+                        raise
+
+                    attempt += 1
+
+        return wrapper
+
+    return decorator
+
+# %% carmen.ipynb 9
+class Clue(BaseModel):
+    """ A clue given by a witness at a location """
+    location: str
+    clue: str
+
+class Clues(BaseModel):
+    """ The clues for the current city """
+    clues: List[Clue] = Field(min_length=1)
+
+class Destinations(BaseModel):
+    """ The cities the detective can travel to """
+    city: Optional[str] = None
+    destinations: List[str]
+
+class GameState(BaseModel):
+    """ The state of a new game """
+    case_id: str
+    suspect_name: str
+    current_city: str
+    stolen_item: str
+    hops: List[str]
+    next_hop: int
+
+class TravelResult(BaseModel):
+    """ The city the detective is in after traveling, or the reason they could not travel """
+    current_city: Optional[str] = None
+    error: Optional[str] = None
+
+class HopContent(BaseModel):
+    """ The clues pointing to a city and other cities to offer as destinations along with it.
+
+    Clues are only generated for cities without facts, the others get theirs from generate_clues_from_facts.
+    """
+    city: str
+    clues: Optional[List[Clue]] = None
+    decoys: List[str] = Field(min_length=3)
+
+class GameContent(BaseModel):
+    """ The clues and destinations for every hop of a game """
+    hops: List[HopContent]
+    arrest_clues: List[Clue] = Field(min_length=1)
+    mistaken_clues: List[Clue] = Field(min_length=1)
+
+class CityFacts(BaseModel):
+    """ Facts about a city that regular clues are built from """
+    country: str
+    currency: str
+    flag_colors: str
+    dish: str
+    attraction: str
+    author: str
+
+# %% carmen.ipynb 10
+_json_fence = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+_trailing_comma = re.compile(r",\s*([}\]])")
+
+def get_output_text(output) -> str:
+    """ Returns the text of a model reply, joining content blocks from providers that return a list """
+    if isinstance(output, list):
+        return "".join(block if isinstance(block, str) else block.get("text", "") for block in output)
+
+    return output
+
+def parse_json_output(text: str):
+    """ Parses json from a model reply, repairing prose, markdown fences, trailing commas and python literals """
+    text = get_output_text(text).strip()
+    candidates = [text]
+
+    fenced = _json_fence.search(text)
+    if fenced:
+        candidates.append(fenced.group(1).strip())
+
+    # Models sometimes drop the outer braces of the hash
+    if text.startswith('"'):
+        candidates.append("{" + text.rstrip(",") + "}")
+
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        candidates.append(text[start:end + 1])
+
+    for candidate in candidates:
+        for repaired in (candidate, _trailing_comma.sub(r"\1", candidate)):
+            try:
+                return json.loads(repaired)
+            except ValueError:
+                pass
+
+        try:
+            value = ast.literal_eval(candidate)
+        except (ValueError, SyntaxError):
+            continue
+
+        if isinstance(value, (dict, list)):
+            return value
+
+    raise ValueError(f"Could not parse json from model output: {text[:200]}")
+
+def parse_structured_output(text: str, schema):
+    """ Parses a model reply and validates it against schema, raises ValueError if either fails """
+    return schema.model_validate(parse_json_output(text))
+
+def is_structured_output_error(e: Exception) -> bool:
+    """ Structured output the provider doesn't support, or a reply that doesn't parse or validate.
+
+    The text reply can recover from these. Rate limits, timeouts and other transient errors are left to the router
+    and retries, asking again in text mode would only double the calls.
+    """
+    if is_failover_error(e):
+        return False
+
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    return isinstance(e, (NotImplementedError, ValueError)) or status in (400, 422)
+
+@functools.lru_cache(maxsize=None)
+def get_structured_llm(provider, purpose, schema):
+    return get_llm(provider, purpose).with_structured_output(schema)
+
+def get_reask_prompt(prompt: str, output: str, error: Exception) -> str:
+    return f"""
+        {prompt}
+
+        Your previous answer was:
+        {output}
+
+        It could not be used because of this error:
+        {error}
+
+        Fix the answer. Output only the json hash. Do not provide any other text output or additional formatting.
+    """
+
+def generate_json(prompt: str, schema) -> str:
+    """ Generates a reply matching schema, re-asking only this generation when the reply is malformed """
+    if STRUCTURED_OUTPUT == "native":
+        try:
+            result = get_generation_llm().with_structured_output(schema).invoke(prompt)
+            # Tool calling structured output returns None when the model answered without calling the tool
+            if result is None:
+                raise ValueError("The model did not return structured output")
+
+            return result.model_dump_json(exclude_none=True)
+        except Exception as e:
+            if not is_structured_output_error(e):
+                raise
+
+            logger.warning(f"Structured output failed for {schema.__name__}, parsing the text reply instead: {e}")
+
+    output = get_output_text(get_generation_llm().invoke(prompt).content)
+    for attempt in range(STRUCTURED_OUTPUT_REASKS + 1):
+        try:
+            return parse_structured_output(output, schema).model_dump_json(exclude_none=True)
+        except ValueError as e:
+            if attempt == STRUCTURED_OUTPUT_REASKS:
+                raise
+
+            output = get_output_text(get_generation_llm().invoke(get_reask_prompt(prompt, output, e)).content)
+
+async def agenerate_json(prompt: str, schema) -> str:
+    if STRUCTURED_OUTPUT == "native":
+        try:
+            result = await get_generation_llm().with_structured_output(schema).ainvoke(prompt)
+            if result is None:
+                raise ValueError("The model did not return structured output")
+
+            return result.model_dump_json(exclude_none=True)
+        except Exception as e:
+            if not is_structured_output_error(e):
+                raise
+
+            logger.warning(f"Structured output failed for {schema.__name__}, parsing the text reply instead: {e}")
+
+    output = get_output_text((await get_generation_llm().ainvoke(prompt)).content)
+    for attempt in range(STRUCTURED_OUTPUT_REASKS + 1):
+        try:
+            return parse_structured_output(output, schema).model_dump_json(exclude_none=True)
+        except ValueError as e:
+            if attempt == STRUCTURED_OUTPUT_REASKS:
+                raise
+
+            output = get_output_text((await get_generation_llm().ainvoke(get_reask_prompt(prompt, output, e))).content)
+
+def get_reformat_prompt(output: str, schema) -> str:
+    return f"""
+        Rewrite the answer below as a json hash matching this json schema:
+        {json.dumps(schema.model_json_schema())}
+
+        Answer:
+        {output}
+
+        Output only the json hash. Do not provide any other text output or additional formatting.
+    """
+
+def parse_agent_output(output, schema) -> dict:
+    """ Validates an agent's final answer, having the generation llm reformat it instead of re-running the agent """
+    try:
+        return parse_structured_output(output, schema).model_dump(exclude_none=True)
+    except ValueError as e:
+        logger.warning(f"Agent output is not a valid {schema.__name__}, reformatting it: {e}")
+
+    return json.loads(generate_json(get_reformat_prompt(get_output_text(output), schema), schema))
+
+async def aparse_agent_output(output, schema) -> dict:
+    try:
+        return parse_structured_output(output, schema).model_dump(exclude_none=True)
+    except ValueError as e:
+        logger.warning(f"Agent output is not a valid {schema.__name__}, reformatting it: {e}")
+
+    return json.loads(await agenerate_json(get_reformat_prompt(get_output_text(output), schema), schema))
+
+# %% carmen.ipynb 12
 def get_redis_host_port():
-    if GAME_ENVIRONMENT == "DEV":
-        return ("localhost", 6379)
-    elif GAME_ENVIRONMENT == "TEST":
-        return ("localhost", 6379)
-    else:
-        raise Exception("Unknown game environment")
-        
+    return (REDIS_HOST, REDIS_PORT)
+
 def get_dbid():
+    if REDIS_DB is not None:
+        return int(REDIS_DB)
+
     if GAME_ENVIRONMENT == "DEV":
         return 1
     elif GAME_ENVIRONMENT == "TEST":
@@ -90,46 +919,609 @@ def get_dbid():
     else:
         return 0
 
-def get_redis_connection():
+def get_redis_nodes() -> list:
+    """ Returns the (host, port) pairs in REDIS_NODES """
+    nodes = []
+    for node in REDIS_NODES.split(","):
+        if node.strip():
+            host, _, port = node.strip().rpartition(":")
+            nodes.append((host, int(port)))
+
+    if not nodes:
+        raise Exception(f"REDIS_NODES needs a host:port for every node in {REDIS_MODE} mode")
+
+    return nodes
+
+def _get_redis_connection_kwargs() -> dict:
+    return {
+        "password": REDIS_PASSWORD,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_SOCKET_CONNECT_TIMEOUT,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+    }
+
+def _get_redis_key() -> tuple:
     host, port = get_redis_host_port()
-    dbid = get_dbid()
-    
-    r = redis.Redis(host=host, port=port, db=dbid)
+
+    return (REDIS_MODE, REDIS_URL, REDIS_NODES, host, port, get_dbid())
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def immediate_execute_command(self, *args, **options):
+        with span("redis", str(args[0]).upper()):
+            return super().immediate_execute_command(*args, **options)
+
+    def execute(self, raise_on_error=True):
+        with span("redis", "PIPELINE"):
+            return super().execute(raise_on_error)
+
+class InstrumentedRedis(redis.Redis):
+    """ Redis client that records a span for every command and pipeline """
+    def execute_command(self, *args, **options):
+        with span("redis", str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class AsyncInstrumentedPipeline(redis.asyncio.client.Pipeline):
+    async def immediate_execute_command(self, *args, **options):
+        with span("redis", str(args[0]).upper()):
+            return await super().immediate_execute_command(*args, **options)
+
+    async def execute(self, raise_on_error=True):
+        with span("redis", "PIPELINE"):
+            return await super().execute(raise_on_error)
+
+class AsyncInstrumentedRedis(redis.asyncio.Redis):
+    async def execute_command(self, *args, **options):
+        with span("redis", str(args[0]).upper()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AsyncInstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def _span_pipeline_execute(pipe):
+    # Cluster pipelines are built from the client's node manager, so their execute is wrapped rather than subclassed
+    execute = pipe.execute
+
+    def traced_execute(*args, **kwargs):
+        with span("redis", "PIPELINE"):
+            return execute(*args, **kwargs)
+
+    pipe.execute = traced_execute
+
+    return pipe
+
+def _aspan_pipeline_execute(pipe):
+    execute = pipe.execute
+
+    async def traced_execute(*args, **kwargs):
+        with span("redis", "PIPELINE"):
+            return await execute(*args, **kwargs)
+
+    pipe.execute = traced_execute
+
+    return pipe
+
+class InstrumentedRedisCluster(redis.cluster.RedisCluster):
+    def execute_command(self, *args, **kwargs):
+        with span("redis", str(args[0]).upper()):
+            return super().execute_command(*args, **kwargs)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        return _span_pipeline_execute(super().pipeline(transaction, shard_hint))
+
+class AsyncInstrumentedRedisCluster(redis.asyncio.cluster.RedisCluster):
+    async def execute_command(self, *args, **kwargs):
+        with span("redis", str(args[0]).upper()):
+            return await super().execute_command(*args, **kwargs)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        return _aspan_pipeline_execute(super().pipeline(transaction, shard_hint))
+
+_redis_pools = {}
+_redis_pools_lock = threading.Lock()
+
+def _create_redis_pool():
+    host, port = get_redis_host_port()
+    kwargs = dict(_get_redis_connection_kwargs(), max_connections=REDIS_MAX_CONNECTIONS)
+
+    if REDIS_MODE == "standalone":
+        if REDIS_URL:
+            return redis.BlockingConnectionPool.from_url(REDIS_URL, **kwargs)
+
+        return redis.BlockingConnectionPool(host=host, port=port, db=get_dbid(), **kwargs)
+    elif REDIS_MODE == "sentinel":
+        sentinel = redis.sentinel.Sentinel(
+            get_redis_nodes(),
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+        )
+
+        # Connections are made to whichever node the sentinels report as the master, so failovers are followed
+        return redis.sentinel.SentinelConnectionPool(REDIS_SENTINEL_SERVICE, sentinel, db=get_dbid(), **kwargs)
+    else:
+        raise Exception(f"Unknown redis mode for a connection pool: {REDIS_MODE}")
+
+def get_redis_pool():
+    key = _get_redis_key()
+
+    with _redis_pools_lock:
+        if key not in _redis_pools:
+            _redis_pools[key] = _create_redis_pool()
+
+        return _redis_pools[key]
+
+def _create_redis_cluster():
+    kwargs = {key: value for key, value in _get_redis_connection_kwargs().items() if key != "health_check_interval"}
+    kwargs["max_connections"] = REDIS_MAX_CONNECTIONS
+
+    if REDIS_URL:
+        return InstrumentedRedisCluster.from_url(REDIS_URL, **kwargs)
+
+    nodes = [redis.cluster.ClusterNode(host, port) for host, port in get_redis_nodes()]
+
+    return InstrumentedRedisCluster(startup_nodes=nodes, **kwargs)
+
+def get_redis_connection():
+    # A cluster client keeps a pool per node and tracks the slots itself, so the client is what gets shared
+    if REDIS_MODE == "cluster":
+        key = _get_redis_key()
+
+        with _redis_pools_lock:
+            if key not in _redis_pools:
+                _redis_pools[key] = _create_redis_cluster()
+
+            return _redis_pools[key]
+
+    r = InstrumentedRedis(connection_pool=get_redis_pool())
 
     return r
 
-# %% carmen.ipynb 5
-def get_game_states():
+def close_redis_connections():
+    with _redis_pools_lock:
+        for pool in _redis_pools.values():
+            if isinstance(pool, redis.cluster.RedisCluster):
+                pool.close()
+            else:
+                pool.disconnect()
+
+        _redis_pools.clear()
+
+_async_redis_pools = weakref.WeakKeyDictionary()
+
+def _create_async_redis_pool():
+    host, port = get_redis_host_port()
+    kwargs = dict(_get_redis_connection_kwargs(), max_connections=REDIS_MAX_CONNECTIONS)
+
+    if REDIS_MODE == "standalone":
+        if REDIS_URL:
+            return redis.asyncio.BlockingConnectionPool.from_url(REDIS_URL, **kwargs)
+
+        return redis.asyncio.BlockingConnectionPool(host=host, port=port, db=get_dbid(), **kwargs)
+    elif REDIS_MODE == "sentinel":
+        sentinel = redis.asyncio.sentinel.Sentinel(
+            get_redis_nodes(),
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+        )
+
+        return redis.asyncio.sentinel.SentinelConnectionPool(REDIS_SENTINEL_SERVICE, sentinel, db=get_dbid(), **kwargs)
+    elif REDIS_MODE == "cluster":
+        if REDIS_URL:
+            return AsyncInstrumentedRedisCluster.from_url(REDIS_URL, **kwargs)
+
+        nodes = [redis.asyncio.cluster.ClusterNode(host, port) for host, port in get_redis_nodes()]
+
+        return AsyncInstrumentedRedisCluster(startup_nodes=nodes, **kwargs)
+    else:
+        raise Exception(f"Unknown redis mode: {REDIS_MODE}")
+
+def get_async_redis_connection():
+    key = _get_redis_key()
+
+    pools = _async_redis_pools.setdefault(asyncio.get_running_loop(), {})
+    if key not in pools:
+        pools[key] = _create_async_redis_pool()
+
+    if REDIS_MODE == "cluster":
+        return pools[key]
+
+    return AsyncInstrumentedRedis(connection_pool=pools[key])
+
+async def aclose_redis_connections():
+    pools = _async_redis_pools.pop(asyncio.get_running_loop(), {})
+    for pool in pools.values():
+        if isinstance(pool, redis.asyncio.cluster.RedisCluster):
+            await pool.aclose()
+        else:
+            await pool.disconnect()
+
+# %% carmen.ipynb 13
+@functools.lru_cache(maxsize=None)
+def get_city_indices() -> dict:
+    # Stored games refer to cities by index so famous_cities must only ever be appended to
+    return {city: index for index, city in enumerate(famous_cities)}
+
+def _compact_city(city):
+    return get_city_indices().get(city, city)
+
+def _expand_city(city):
+    return famous_cities[city] if isinstance(city, int) else city
+
+def _map_game_state_cities(fields: dict, map_city) -> dict:
+    fields = dict(fields)
+
+    if "current_city" in fields:
+        fields["current_city"] = map_city(fields["current_city"])
+
+    if "hops" in fields:
+        fields["hops"] = [map_city(city) for city in fields["hops"]]
+
+    if "hop_content" in fields:
+        hop_content = {}
+        for hop, content in fields["hop_content"].items():
+            content = dict(content)
+            for key in ["destinations", "decoys"]:
+                if key in content:
+                    content[key] = [map_city(city) for city in content[key]]
+
+            hop_content[hop] = content
+
+        fields["hop_content"] = hop_content
+
+    return fields
+
+def compact_game_state_fields(fields: dict) -> dict:
+    """ Replaces the names of the cities in famous_cities with their index """
+    return _map_game_state_cities(fields, _compact_city)
+
+def expand_game_state_fields(fields: dict) -> dict:
+    """ Reverses compact_game_state_fields, fields stored by name are returned as is """
+    return _map_game_state_cities(fields, _expand_city)
+
+def _dump_json(value) -> str:
+    if GAME_STATE_ENCODING == "compact":
+        return json.dumps(value, separators=(",", ":"))
+    elif GAME_STATE_ENCODING == "plain":
+        return json.dumps(value)
+    else:
+        raise Exception(f"Unknown game state encoding: {GAME_STATE_ENCODING}")
+
+def dump_game_state(game_state: dict) -> str:
+    if GAME_STATE_ENCODING == "compact":
+        game_state = compact_game_state_fields(game_state)
+
+    return _dump_json(game_state)
+
+def load_game_state(value) -> dict:
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+
+    return expand_game_state_fields(json.loads(value))
+
+def _encode_game_state_fields(fields: dict) -> dict:
+    if GAME_STATE_ENCODING == "compact":
+        fields = compact_game_state_fields(fields)
+
+    return {key: _dump_json(value) for key, value in fields.items()}
+
+def _decode_game_state_fields(mapping: dict) -> dict:
+    return expand_game_state_fields({key.decode('utf-8'): json.loads(value) for key, value in mapping.items()})
+
+def _mget(r, keys):
+    # Games hash to different slots on a cluster, which a single MGET can't span
+    if REDIS_MODE == "cluster":
+        return r.mget_nonatomic(keys)
+
+    return r.mget(keys)
+
+def _read_game_states(r, keys):
+    if len(keys) == 0:
+        return []
+
+    if GAME_STATE_STORAGE == "json":
+        values = _mget(r, keys)
+        return [load_game_state(value) if value is not None else None for value in values]
+    elif GAME_STATE_STORAGE == "hash":
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return [_decode_game_state_fields(value) if value else None for value in pipe.execute()]
+    else:
+        raise Exception(f"Unknown game state storage: {GAME_STATE_STORAGE}")
+
+def get_game_key(case_id) -> str:
+    return f"{GAME_KEY_PREFIX}{case_id}"
+
+def _batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def iter_game_states(batch_size: int = 500, prefix: str = None, filter_fn=None):
+    """ Yields (case_id, game_state) for every stored game, reading them from redis batch_size keys at a time """
+    if prefix is None:
+        prefix = GAME_KEY_PREFIX
+
     r = get_redis_connection()
-    
-    keys = r.keys('*')
-    values = r.mget(keys)
 
+    keys = r.scan_iter(match=f"{prefix}*", count=batch_size)
+    for batch in _batched(keys, batch_size):
+        for key, game_state in zip(batch, _read_game_states(r, batch)):
+            # The game may have been deleted since the scan returned its key
+            if game_state is None:
+                continue
+
+            if filter_fn is None or filter_fn(game_state):
+                yield key.decode('utf-8')[len(prefix):], game_state
+
+def get_game_states(filter_fn=None):
     game_states = {}
-    for key, value in zip(keys, values):
-        game_states[key.decode('utf-8')] = value.decode('utf-8')
+    for case_id, game_state in iter_game_states(filter_fn=filter_fn):
+        game_states[case_id] = json.dumps(game_state)
 
     return game_states
 
-# %% carmen.ipynb 6
-def clear_game_states():
+# %% carmen.ipynb 14
+def clear_game_states(batch_size: int = 500):
     r = get_redis_connection()
 
-    r.flushdb()
+    keys = r.scan_iter(match=f"{GAME_KEY_PREFIX}*", count=batch_size)
+    for batch in _batched(keys, batch_size):
+        r.unlink(*batch)
 
-# %% carmen.ipynb 8
+# %% carmen.ipynb 17
 def store_game_state(game_state: dict):
     r = get_redis_connection()
 
-    r.set(game_state["case_id"], json.dumps(game_state))
+    key = get_game_key(game_state["case_id"])
+    if GAME_STATE_STORAGE == "json":
+        r.set(key, dump_game_state(game_state), ex=GAME_TTL or None)
+    elif GAME_STATE_STORAGE == "hash":
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(key, mapping=_encode_game_state_fields(game_state))
+        if GAME_TTL:
+            pipe.expire(key, GAME_TTL)
+        pipe.execute()
+    else:
+        raise Exception(f"Unknown game state storage: {GAME_STATE_STORAGE}")
 
-# %% carmen.ipynb 9
+# %% carmen.ipynb 18
 def get_game_state(case_id: str):
     r = get_redis_connection()
 
-    return json.loads(r.get(case_id).decode('utf-8'))
+    game_state = _read_game_states(r, [get_game_key(case_id)])[0]
+    if game_state is None:
+        raise Exception(f"Unknown case_id: {case_id}")
+
+    return game_state
+
+# %% carmen.ipynb 20
+# Only touches the given fields of an existing game and restarts its ttl (ARGV[1], 0 for none), in a single round trip.
+# Finished games get ARGV[2] instead when it is set, so later writes don't extend them
+_hset_existing_script = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local ttl = tonumber(ARGV[1])
+if tonumber(ARGV[2]) > 0 and redis.call('HEXISTS', KEYS[1], 'finished') == 1 then
+    ttl = tonumber(ARGV[2])
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+return 1
+"""
+
+# Sets finished (ARGV[2]) on an existing game and shortens its ttl to ARGV[1] (0 keeps it). Returns 1 only for the call
+# that finished the game, so concurrent finishing requests archive it once
+_finish_script = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local finished = redis.call('HEXISTS', KEYS[1], 'finished')
+redis.call('HSET', KEYS[1], 'finished', ARGV[2])
+if tonumber(ARGV[1]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 1 - finished
+"""
+
+def get_game_ttl(game_state: dict) -> int:
+    """ Seconds a write keeps the game in redis, finished games keep the shorter GAME_FINISHED_TTL """
+    if game_state.get("finished") and GAME_FINISHED_TTL:
+        return GAME_FINISHED_TTL
+
+    return GAME_TTL
+
+def is_finishing_update(fields: dict) -> bool:
+    """ Whether the update moves the player on to the arrest """
+    return str(fields.get("next_hop")) == str(MAX_HOPS + 1)
+
+_archive_lock = threading.Lock()
+
+def archive_game_state(game_state: dict, path: str = None):
+    """ Appends the game to the archive, every call adds a separate gzip member so a crash can't corrupt older games """
+    member = gzip.compress((json.dumps(game_state) + "\n").encode('utf-8'))
+
+    # A single unbuffered append per game keeps the members of different worker processes from interleaving
+    with _archive_lock:
+        with open(path or GAME_ARCHIVE_PATH, "ab", buffering=0) as f:
+            f.write(member)
+
+def iter_archived_game_states(path: str = None):
+    """ Yields the archived games in the order they were finished """
+    with gzip.open(path or GAME_ARCHIVE_PATH, "rt") as f:
+        for line in f:
+            yield json.loads(line)
+
+def finish_game(case_id: str):
+    """ Archives a game that reached the arrest and shortens its ttl so it doesn't stay in redis """
+    r = get_redis_connection()
+    key = get_game_key(case_id)
 
-# %% carmen.ipynb 14
+    # The game is checked and marked finished atomically, so traveling to the last city again or concurrent requests
+    # can't archive it twice
+    if GAME_STATE_STORAGE == "json":
+        def mark_finished(pipe):
+            value = pipe.get(key)
+            if value is None:
+                raise Exception(f"Unknown case_id: {case_id}")
+
+            game_state = load_game_state(value)
+            finished = game_state.get("finished", False)
+            game_state["finished"] = True
+
+            pipe.multi()
+            pipe.set(key, dump_game_state(game_state), ex=get_game_ttl(game_state) or None)
+
+            return not finished
+
+        first = r.transaction(mark_finished, key, value_from_callable=True)
+    elif GAME_STATE_STORAGE == "hash":
+        args = [GAME_FINISHED_TTL, _encode_game_state_fields({"finished": True})["finished"]]
+        first = r.register_script(_finish_script)(keys=[key], args=args)
+    else:
+        raise Exception(f"Unknown game state storage: {GAME_STATE_STORAGE}")
+
+    if first and GAME_ARCHIVE_PATH:
+        archive_game_state(get_game_state(case_id))
+
+def update_game_state_fields(case_id: str, fields: dict):
+    r = get_redis_connection()
+    key = get_game_key(case_id)
+
+    if GAME_STATE_STORAGE == "json":
+        def merge_fields(pipe):
+            value = pipe.get(key)
+            if value is None:
+                raise Exception(f"Unknown case_id: {case_id}")
+
+            game_state = load_game_state(value)
+            game_state.update(fields)
+
+            pipe.multi()
+            pipe.set(key, dump_game_state(game_state), ex=get_game_ttl(game_state) or None)
+
+        # Retries if another client changes the game between the read and the write
+        r.transaction(merge_fields, key)
+    elif GAME_STATE_STORAGE == "hash":
+        args = [GAME_TTL, GAME_FINISHED_TTL] + [item for pair in _encode_game_state_fields(fields).items() for item in pair]
+        if not r.register_script(_hset_existing_script)(keys=[key], args=args):
+            raise Exception(f"Unknown case_id: {case_id}")
+    else:
+        raise Exception(f"Unknown game state storage: {GAME_STATE_STORAGE}")
+
+    if is_finishing_update(fields):
+        finish_game(case_id)
+
+# %% carmen.ipynb 21
+async def _aread_game_states(r, keys):
+    if len(keys) == 0:
+        return []
+
+    if GAME_STATE_STORAGE == "json":
+        values = await _mget(r, keys)
+        return [load_game_state(value) if value is not None else None for value in values]
+    elif GAME_STATE_STORAGE == "hash":
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return [_decode_game_state_fields(value) if value else None for value in await pipe.execute()]
+    else:
+        raise Exception(f"Unknown game state storage: {GAME_STATE_STORAGE}")
+
+async def astore_game_state(game_state: dict):
+    r = get_async_redis_connection()
+
+    key = get_game_key(game_state["case_id"])
+    if GAME_STATE_STORAGE == "json":
+        await r.set(key, dump_game_state(game_state), ex=GAME_TTL or None)
+    elif GAME_STATE_STORAGE == "hash":
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(key, mapping=_encode_game_state_fields(game_state))
+        if GAME_TTL:
+            pipe.expire(key, GAME_TTL)
+        await pipe.execute()
+    else:
+        raise Exception(f"Unknown game state storage: {GAME_STATE_STORAGE}")
+
+async def aget_game_state(case_id: str):
+    r = get_async_redis_connection()
+
+    game_state = (await _aread_game_states(r, [get_game_key(case_id)]))[0]
+    if game_state is None:
+        raise Exception(f"Unknown case_id: {case_id}")
+
+    return game_state
+
+async def aupdate_game_state_fields(case_id: str, fields: dict):
+    r = get_async_redis_connection()
+    key = get_game_key(case_id)
+
+    if GAME_STATE_STORAGE == "json":
+        async def merge_fields(pipe):
+            value = await pipe.get(key)
+            if value is None:
+                raise Exception(f"Unknown case_id: {case_id}")
+
+            game_state = load_game_state(value)
+            game_state.update(fields)
+
+            pipe.multi()
+            pipe.set(key, dump_game_state(game_state), ex=get_game_ttl(game_state) or None)
+
+        await r.transaction(merge_fields, key)
+    elif GAME_STATE_STORAGE == "hash":
+        args = [GAME_TTL, GAME_FINISHED_TTL] + [item for pair in _encode_game_state_fields(fields).items() for item in pair]
+        if not await r.register_script(_hset_existing_script)(keys=[key], args=args):
+            raise Exception(f"Unknown case_id: {case_id}")
+    else:
+        raise Exception(f"Unknown game state storage: {GAME_STATE_STORAGE}")
+
+    if is_finishing_update(fields):
+        await afinish_game(case_id)
+
+async def afinish_game(case_id: str):
+    r = get_async_redis_connection()
+    key = get_game_key(case_id)
+
+    if GAME_STATE_STORAGE == "json":
+        async def mark_finished(pipe):
+            value = await pipe.get(key)
+            if value is None:
+                raise Exception(f"Unknown case_id: {case_id}")
+
+            game_state = load_game_state(value)
+            finished = game_state.get("finished", False)
+            game_state["finished"] = True
+
+            pipe.multi()
+            pipe.set(key, dump_game_state(game_state), ex=get_game_ttl(game_state) or None)
+
+            return not finished
+
+        first = await r.transaction(mark_finished, key, value_from_callable=True)
+    elif GAME_STATE_STORAGE == "hash":
+        args = [GAME_FINISHED_TTL, _encode_game_state_fields({"finished": True})["finished"]]
+        first = await r.register_script(_finish_script)(keys=[key], args=args)
+    else:
+        raise Exception(f"Unknown game state storage: {GAME_STATE_STORAGE}")
+
+    if first and GAME_ARCHIVE_PATH:
+        await asyncio.to_thread(archive_game_state, await aget_game_state(case_id))
+
+# %% carmen.ipynb 26
 famous_cities = [
     "Paris", "New York City", "London", "Tokyo", "Rome",
     "Sydney", "Hong Kong", "Venice", "Barcelona", "Rio de Janeiro",
@@ -143,9 +1535,9 @@ famous_cities = [
     "Oslo", "Lisbon", "Montreal", "Chicago", "Florence"
 ]
 
-# %% carmen.ipynb 15
-def generate_new_game():
-    new_game_prompt = f"""
+# %% carmen.ipynb 27
+def get_new_game_prompt() -> str:
+    return f"""
     System: You are the game master for a detective game like "where in the world is Carmen San Diego". 
     User: To start the game, generate the following and return it as a json hash. 
     1. A random uuid, key: case_id
@@ -179,15 +1571,48 @@ def generate_new_game():
     Assistant:
     """
 
-    return get_generation_llm().invoke(new_game_prompt).content
-    
+def generate_new_game():
+    prompt = get_new_game_prompt()
 
-# %% carmen.ipynb 17
-@retry(stop_max_delay=15000, stop_max_attempt_number=3)
-def new_game():
-    game_state = json.loads(generate_new_game())
-    store_game_state(game_state)
+    return generate_json(prompt, GameState)
+
+async def agenerate_new_game() -> str:
+    prompt = get_new_game_prompt()
+
+    return await agenerate_json(prompt, GameState)
+
+# %% carmen.ipynb 28
+def validate_game_state(game_state: dict):
+    for field in ["case_id", "suspect_name", "current_city", "stolen_item", "hops", "next_hop"]:
+        if field not in game_state:
+            raise Exception(f"Game state is missing {field}")
 
+    hops = game_state["hops"]
+    if len(hops) != MAX_HOPS + 1 or len(set(hops)) != len(hops):
+        raise Exception(f"Game state needs {MAX_HOPS + 1} unique hops: {hops}")
+
+    if hops[0] != game_state["current_city"] or game_state["next_hop"] != 1:
+        raise Exception("Game state must start in the first hop")
+
+def get_game_pool_key(provider=None) -> str:
+    return f"carmen:pool:{provider or model_provider}"
+
+def pop_pooled_game():
+    value = get_redis_connection().lpop(get_game_pool_key())
+    if value is None:
+        return None
+
+    return load_game_state(value)
+
+async def apop_pooled_game():
+    value = await get_async_redis_connection().lpop(get_game_pool_key())
+    if value is None:
+        return None
+
+    return load_game_state(value)
+
+# %% carmen.ipynb 30
+def get_new_game_response(game_state: dict) -> dict:
     res_fields = ["case_id", "suspect_name", "current_city", "stolen_item"]
     res = {}
 
@@ -196,67 +1621,494 @@ def new_game():
         
     return res
 
-# %% carmen.ipynb 21
-@tool
-def fetch_game_state(case_id: str) -> str:
-    """ Fetch the game state given the case_id """
-    return json.dumps(get_game_state(case_id))
+@retry(stop_max_delay=15000, stop_max_attempt_number=3)
+def new_game():
+    game_state = pop_pooled_game()
+    if game_state is None:
+        game_state = json.loads(generate_new_game())
+        validate_game_state(game_state)
+
+        if HOP_CONTENT_GENERATION != "lazy":
+            game_state["hop_content"] = generate_game_content(game_state)
+
+    # Models tend to repeat the example uuid so case ids are always assigned here
+    game_state["case_id"] = str(uuid.uuid4())
+    store_game_state(game_state)
+
+    return get_new_game_response(game_state)
+
+@aretry(stop_max_delay=15000, stop_max_attempt_number=3)
+async def anew_game():
+    game_state = await apop_pooled_game()
+    if game_state is None:
+        game_state = json.loads(await agenerate_new_game())
+        validate_game_state(game_state)
+
+        if HOP_CONTENT_GENERATION != "lazy":
+            game_state["hop_content"] = await agenerate_game_content(game_state)
+
+    game_state["case_id"] = str(uuid.uuid4())
+    await astore_game_state(game_state)
+
+    return get_new_game_response(game_state)
+
+# %% carmen.ipynb 34
+class ToolCache:
+    """ Results of read-only tool calls made during a single agent run.
+
+    Tools of one turn run on several threads. Every invalidation bumps the generation, and a result computed while the
+    generation changed is returned but not cached, since it may have been read before the write that invalidated it.
+    """
+    def __init__(self):
+        self.values = {}
+        # Parsed game states fetched during the run, passed to python snippets so they don't embed and re-parse json
+        self.game_states = {}
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, tool_name: str, key: str, compute):
+        with self.lock:
+            if (tool_name, key) in self.values:
+                self.hits += 1
+                return self.values[(tool_name, key)]
+
+            self.misses += 1
+            generation = self.generation
+
+        value = compute()
+
+        with self.lock:
+            if self.generation == generation:
+                self.values[(tool_name, key)] = value
+
+        return value
+
+    def add_game_state(self, case_id: str, game_state: dict, generation: int):
+        """ Keeps a game state read at generation unless the cache was invalidated since """
+        with self.lock:
+            if self.generation == generation:
+                self.game_states[case_id] = game_state
+
+    def get_game_states(self) -> dict:
+        with self.lock:
+            return dict(self.game_states)
+
+    def invalidate(self, tool_name: str = None):
+        """ Drops the cached results of tool_name, or of every tool if it isn't given """
+        with self.lock:
+            self.generation += 1
+            if tool_name is None:
+                self.values = {}
+                self.game_states = {}
+            else:
+                self.values = {key: value for key, value in self.values.items() if key[0] != tool_name}
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+# Set for the duration of invoke_agent / ainvoke_agent, tools called outside an agent run are not cached
+_tool_cache = contextvars.ContextVar("tool_cache", default=None)
+
+def cached_tool_call(tool_name: str, key: str, compute):
+    cache = _tool_cache.get()
+    if cache is None:
+        return compute()
+
+    return cache.get(tool_name, key, compute)
+
+def invalidate_tool_cache(tool_name: str = None):
+    cache = _tool_cache.get()
+    if cache is not None:
+        cache.invalidate(tool_name)
+
+# %% carmen.ipynb 35
+@tool
+def fetch_game_state(case_id: str) -> str:
+    """ Fetch the game state given the case_id """
+    def fetch():
+        cache = _tool_cache.get()
+        generation = cache.generation if cache is not None else None
+
+        game_state = get_game_state(case_id)
+        if cache is not None:
+            cache.add_game_state(case_id, game_state, generation)
+
+        return json.dumps(game_state)
+
+    return cached_tool_call("fetch_game_state", case_id, fetch)
+
+# %% carmen.ipynb 37
+@tool
+def set_current_city(case_id: str, current_city: str):
+    """ Sets the current city for the given case_id """
+    update_game_state_fields(case_id, {"current_city": current_city})
+    invalidate_tool_cache()
+    
+
+# %% carmen.ipynb 39
+@tool
+def update_game_state(case_id, key, value):
+    """ Updates the game state based on the values given """
+    update_game_state_fields(case_id, {key: value})
+    invalidate_tool_cache()
+
+# %% carmen.ipynb 41
+def _normalize_cache_arg(value):
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    elif isinstance(value, list):
+        return sorted(_normalize_cache_arg(item) for item in value)
+    else:
+        return value
+
+def get_generation_cache_key(name: str, args: dict) -> str:
+    normalized = json.dumps({key: _normalize_cache_arg(value) for key, value in args.items()}, sort_keys=True)
+
+    return f"carmen:cache:{name}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
+
+def _is_json(value: str) -> bool:
+    try:
+        json.loads(value)
+    except ValueError:
+        return False
+
+    return True
+
+def cached_generation(name: str, args: dict, generate) -> str:
+    """ Returns a cached variant for the tool name and arguments, calling generate until there are enough variants """
+    if GENERATION_CACHE_VARIANTS <= 0:
+        return generate()
+
+    r = get_redis_connection()
+    key = get_generation_cache_key(name, args)
+
+    variants = r.lrange(key, 0, -1)
+    if len(variants) >= GENERATION_CACHE_VARIANTS:
+        return random.choice(variants).decode('utf-8')
+
+    value = generate()
+    # Malformed output is returned to the caller as before but never cached
+    if _is_json(value):
+        pipe = r.pipeline(transaction=True)
+        pipe.rpush(key, value)
+        pipe.ltrim(key, -GENERATION_CACHE_VARIANTS, -1)
+        pipe.expire(key, GENERATION_CACHE_TTL)
+        pipe.execute()
+
+    return value
+
+async def acached_generation(name: str, args: dict, agenerate) -> str:
+    if GENERATION_CACHE_VARIANTS <= 0:
+        return await agenerate()
+
+    r = get_async_redis_connection()
+    key = get_generation_cache_key(name, args)
+
+    variants = await r.lrange(key, 0, -1)
+    if len(variants) >= GENERATION_CACHE_VARIANTS:
+        return random.choice(variants).decode('utf-8')
+
+    value = await agenerate()
+    if _is_json(value):
+        pipe = r.pipeline(transaction=True)
+        pipe.rpush(key, value)
+        pipe.ltrim(key, -GENERATION_CACHE_VARIANTS, -1)
+        pipe.expire(key, GENERATION_CACHE_TTL)
+        await pipe.execute()
+
+    return value
+
+async def astream_generation(prompt: str):
+    async for chunk in get_generation_llm().astream(prompt):
+        yield chunk.content
+
+async def astream_cached_generation(name: str, args: dict, prompt: str, schema):
+    """ Streams the generation for prompt, or a cached variant in one piece, and caches the streamed output.
+
+    The streamed output is validated against schema like generate_json does. Output that doesn't match raises
+    ValueError once the stream is done and is not cached, so the caller can fall back to agenerate_json.
+    """
+    if GENERATION_CACHE_VARIANTS > 0:
+        r = get_async_redis_connection()
+        key = get_generation_cache_key(name, args)
+
+        variants = await r.lrange(key, 0, -1)
+        if len(variants) >= GENERATION_CACHE_VARIANTS:
+            yield random.choice(variants).decode('utf-8')
+            return
+
+    chunks = []
+    async for text in astream_generation(prompt):
+        chunks.append(text)
+        yield text
+
+    value = parse_structured_output("".join(chunks), schema).model_dump_json(exclude_none=True)
+    if GENERATION_CACHE_VARIANTS > 0:
+        pipe = r.pipeline(transaction=True)
+        pipe.rpush(key, value)
+        pipe.ltrim(key, -GENERATION_CACHE_VARIANTS, -1)
+        pipe.expire(key, GENERATION_CACHE_TTL)
+        await pipe.execute()
+
+# %% carmen.ipynb 42
+class JsonStreamParser:
+    """ Incrementally scans json text from an llm token stream.
+
+    feed() returns the values that completed with the new text: ("item", value) for every object or array inside
+    an array and ("member", (key, value)) for every member of a top level object. Text outside of json, like
+    prose or markdown fences, is skipped. Values that don't parse are skipped too and set malformed, so the caller
+    can fall back to a validated generation once the stream is done.
+    """
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.member_start = None
+        self.malformed = False
+
+    def feed(self, text: str) -> list:
+        self.buffer += text
+        events = []
+
+        while self.position < len(self.buffer):
+            i = self.position
+            char = self.buffer[i]
+            self.position += 1
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"' and self.stack:
+                self.in_string = True
+            elif char in "{[":
+                self.stack.append((char, i))
+                if len(self.stack) == 1 and char == "{":
+                    self.member_start = i + 1
+            elif char in "}]" and self.stack:
+                if len(self.stack) == 1 and char == "}":
+                    events.extend(self._member(i))
+
+                _, start = self.stack.pop()
+                if self.stack and self.stack[-1][0] == "[":
+                    events.extend(("item", value) for value in self._parse(self.buffer[start:i + 1]))
+            elif char == "," and len(self.stack) == 1 and self.stack[0][0] == "{":
+                events.extend(self._member(i))
+                self.member_start = i + 1
+
+        return events
+
+    def _parse(self, text: str) -> list:
+        try:
+            return [json.loads(text)]
+        except ValueError:
+            self.malformed = True
+            return []
+
+    def _member(self, end: int) -> list:
+        text = self.buffer[self.member_start:end]
+        if text.strip() == "":
+            return []
+
+        return [("member", item) for value in self._parse("{" + text + "}") for item in value.items()]
+
+# %% carmen.ipynb 44
+def get_destinations_prompt(previous_city: str, next_city: str, current_city: str, exclude_list: str) -> str:
+    return f"""
+        System: You are the game master for a detective game like "where in the world is Carmen San Diego". 
+        User: Generate a list of 4 cities. The list must include {previous_city}, {next_city} 
+        and 2 other cities. It must not include {current_city} or any of the
+        cities in {exclude_list}. Order the list so that {previous_city} and {next_city} are randomly
+        interspersed in the list.
+        
+        Return this as a json list named destinations. 
+
+        Here is an example of the json format:
+        destinations: [
+            <city 1>,
+            <city 2>,
+            <city 3>,
+            <city 4>
+        ]
+
+        Do not include any additional text or additional formatting.
+        Assistant:
+        """
+
+@tool
+def generate_destinations(previous_city: str, next_city: str, current_city: str, exclude_list: str) -> str:
+    """ Generates destinations for the player to travel to given the current city, previous city, 
+    the next city, and a list of cities to exclude """
+    prompt = get_destinations_prompt(previous_city, next_city, current_city, exclude_list)
+
+    cache_args = {
+        "previous_city": previous_city,
+        "next_city": next_city,
+        "current_city": current_city,
+        "exclude_list": exclude_list.split(",")
+    }
+
+    def generate():
+        destinations = json.loads(generate_json(prompt, Destinations))["destinations"]
+        destinations = repair_destinations(destinations, previous_city, next_city, current_city, exclude_list)
+
+        return json.dumps({"destinations": destinations})
+
+    return cached_generation("generate_destinations", cache_args, generate)
+
+async def agenerate_destinations(previous_city: str, next_city: str, current_city: str, exclude_list: str) -> str:
+    prompt = get_destinations_prompt(previous_city, next_city, current_city, exclude_list)
+
+    cache_args = {
+        "previous_city": previous_city,
+        "next_city": next_city,
+        "current_city": current_city,
+        "exclude_list": exclude_list.split(",")
+    }
+
+    async def agenerate():
+        destinations = json.loads(await agenerate_json(prompt, Destinations))["destinations"]
+        destinations = repair_destinations(destinations, previous_city, next_city, current_city, exclude_list)
+
+        return json.dumps({"destinations": destinations})
+
+    return await acached_generation("generate_destinations", cache_args, agenerate)
+
+# %% carmen.ipynb 46
+clue_locations = ["Tourism Desk", "Bank", "Embassy", "Restaurant", "Library"]
+
+# %% carmen.ipynb 47
+city_fact_fields = ["country", "currency", "flag_colors", "dish", "attraction", "author"]
+
+clue_templates = {
+    "Tourism Desk": "The suspect was interested in visiting {attraction}",
+    "Bank": "The suspect changed their currency to {currency}",
+    "Embassy": "The suspect enquired about visiting a country with a {flag_colors} flag",
+    "Restaurant": "The suspect was looking for {dish}",
+    "Library": "The suspect was asking for books by {author}",
+}
+
+def get_city_facts_prompt(city: str) -> str:
+    return f"""
+        System: You are the game master for a detective game like "where in the world is Carmen San Diego". 
+        User: Return facts about {city} as a json hash with the following keys:
+        1. country: the country the city is in
+        2. currency: the currency of the country in plural form, for example "Pounds"
+        3. flag_colors: the colors of the country's flag, for example "red, white, and blue"
+        4. dish: a famous food from the city or country, for example "fresh samosas"
+        5. attraction: a famous tourist attraction in the city, for example "the Eiffel Tower"
+        6. author: a famous author from the country, for example "Charles Dickens"
+
+        Do not generate any additional text or additional formatting.
+
+        Assistant:
+    """
+
+def validate_city_facts(facts: dict):
+    for field in city_fact_fields:
+        if not isinstance(facts.get(field), str) or facts[field].strip() == "":
+            raise Exception(f"City facts are missing {field}")
+
+@retry(stop_max_delay=60000, stop_max_attempt_number=3)
+def generate_city_facts(city: str) -> dict:
+    facts = json.loads(generate_json(get_city_facts_prompt(city), CityFacts))
+    validate_city_facts(facts)
+
+    return {field: facts[field].strip() for field in city_fact_fields}
+
+def build_city_facts(path: str = CITY_FACTS_PATH, cities: list = None):
+    """ Offline step that generates and validates facts for each city and writes them to path """
+    city_facts = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            city_facts = json.load(f)
+
+    for city in (cities or famous_cities):
+        city_facts[city] = generate_city_facts(city)
+
+    with open(path, "w") as f:
+        json.dump(dict(sorted(city_facts.items())), f, indent=4, ensure_ascii=False)
+        f.write("\n")
+
+    load_city_facts.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def load_city_facts(path: str = CITY_FACTS_PATH) -> dict:
+    if not os.path.exists(path):
+        logger.warning(f"No city facts at {path}, regular clues will be generated by the llm")
+        return {}
 
-# %% carmen.ipynb 23
-@tool
-def set_current_city(case_id: str, current_city: str):
-    """ Sets the current city for the given case_id """
-    game_state = get_game_state(case_id)
-    game_state["current_city"] = current_city
+    with open(path) as f:
+        city_facts = json.load(f)
 
-    store_game_state(game_state)
-    
+    return {city.casefold(): facts for city, facts in city_facts.items()}
 
-# %% carmen.ipynb 25
-@tool
-def update_game_state(case_id, key, value):
-    """ Updates the game state based on the values given """
-    game_state = get_game_state(case_id)
-    game_state[key] = value
+def get_city_facts(city: str):
+    return load_city_facts().get(city.strip().casefold())
 
-    store_game_state(game_state)
+def generate_clues_from_facts(facts: dict) -> str:
+    locations = random.sample(clue_locations, 3)
+    clues = [{"location": location, "clue": clue_templates[location].format(**facts)} for location in locations]
 
-# %% carmen.ipynb 27
-@tool
-def generate_destinations(previous_city: str, next_city: str, current_city: str, exclude_list: str) -> str:
-    """ Generates destinations for the player to travel to given the current city, previous city, 
-    the next city, and a list of cities to exclude """
-    prompt = f"""
+    return json.dumps({"clues": clues})
+
+# %% carmen.ipynb 48
+def get_reword_clues_prompt(clues_json: str) -> str:
+    return f"""
         System: You are the game master for a detective game like "where in the world is Carmen San Diego". 
-        User: Generate a list of 4 cities. The list must include {previous_city}, {next_city} 
-        and 2 other cities. It must not include {current_city} or any of the
-        cities in {exclude_list}. Order the list so that {previous_city} and {next_city} are randomly
-        interspersed in the list.
-        
-        Return this as a json list named destinations. 
+        User: Reword each of the clues below so they sound like a witness talking to the detective. Keep the 
+        location of each clue and every fact mentioned in it unchanged.
 
-        Here is an example of the json format:
-        destinations: [
-            <city 1>,
-            <city 2>,
-            <city 3>,
-            <city 4>
-        ]
+        {clues_json}
+
+        Return the clues in exactly the same json format. Do not generate any additional text or additional formatting.
 
-        Do not include any additional text or additional formatting.
         Assistant:
-        """
+    """
 
-    return get_generation_llm().invoke(prompt).content
+def _reworded_or_original(clues_json: str, reworded_json: str) -> str:
+    # Falls back to the fact based clues if the llm mangled them
+    try:
+        clues = json.loads(clues_json)["clues"]
+        reworded = json.loads(reworded_json)["clues"]
+    except (ValueError, KeyError, TypeError):
+        return clues_json
+
+    if [clue.get("location") for clue in reworded] != [clue["location"] for clue in clues]:
+        return clues_json
+
+    return reworded_json
+
+def reword_clues(clues_json: str) -> str:
+    prompt = get_reword_clues_prompt(clues_json)
+    reworded_json = cached_generation(
+        "reword_clues",
+        {"clues": clues_json},
+        lambda: generate_json(prompt, Clues)
+    )
 
-# %% carmen.ipynb 29
-clue_locations = ["Tourism Desk", "Bank", "Embassy", "Restaurant", "Library"]
+    return _reworded_or_original(clues_json, reworded_json)
 
-# %% carmen.ipynb 30
-@tool
-def generate_regular_clues(city: str) -> str:
-    """ Generate regular clues given a location """
-    prompt = f"""
+async def areword_clues(clues_json: str) -> str:
+    prompt = get_reword_clues_prompt(clues_json)
+
+    async def agenerate():
+        return await agenerate_json(prompt, Clues)
+
+    reworded_json = await acached_generation("reword_clues", {"clues": clues_json}, agenerate)
+
+    return _reworded_or_original(clues_json, reworded_json)
+
+# %% carmen.ipynb 50
+def get_regular_clues_prompt(city: str) -> str:
+    return f"""
         System: You are the game master for a detective game like "where in the world is Carmen San Diego". 
         User: Generate 3 clues. To generate each clue, do the following 
         1. Pick 3 locations from {clue_locations}. Pick them in random order.
@@ -302,13 +2154,39 @@ def generate_regular_clues(city: str) -> str:
 
         Assistant:
     """
-    return get_generation_llm().invoke(prompt).content
 
-# %% carmen.ipynb 32
 @tool
-def generate_mistaken_clues() -> str:
-    """ Generate mistaken clues """
-    prompt = f"""
+def generate_regular_clues(city: str) -> str:
+    """ Generate regular clues given a location """
+    facts = get_city_facts(city)
+    if facts is not None:
+        clues_json = generate_clues_from_facts(facts)
+        return reword_clues(clues_json) if CLUE_REWORDING else clues_json
+
+    prompt = get_regular_clues_prompt(city)
+
+    cache_args = {"city": city}
+
+    return cached_generation("generate_regular_clues", cache_args, lambda: generate_json(prompt, Clues))
+
+async def agenerate_regular_clues(city: str) -> str:
+    facts = get_city_facts(city)
+    if facts is not None:
+        clues_json = generate_clues_from_facts(facts)
+        return await areword_clues(clues_json) if CLUE_REWORDING else clues_json
+
+    prompt = get_regular_clues_prompt(city)
+
+    cache_args = {"city": city}
+
+    async def agenerate():
+        return await agenerate_json(prompt, Clues)
+
+    return await acached_generation("generate_regular_clues", cache_args, agenerate)
+
+# %% carmen.ipynb 52
+def get_mistaken_clues_prompt() -> str:
+    return f"""
         System: You are the game master for a detective game like "where in the world is Carmen San Diego". 
         User: Generate 3 clues. To generate each clue, do the following 
         1. Pick 3 locations at random out of {clue_locations}. 
@@ -339,13 +2217,29 @@ def generate_mistaken_clues() -> str:
 
         Game Master:
     """
-    return get_generation_llm().invoke(prompt).content
 
-# %% carmen.ipynb 34
 @tool
-def generate_arrest_clues(suspect_name: str) -> str:
-    """ Generate arrest clues given the name of the suspect"""
-    prompt = f"""
+def generate_mistaken_clues() -> str:
+    """ Generate mistaken clues """
+    prompt = get_mistaken_clues_prompt()
+
+    cache_args = {}
+
+    return cached_generation("generate_mistaken_clues", cache_args, lambda: generate_json(prompt, Clues))
+
+async def agenerate_mistaken_clues() -> str:
+    prompt = get_mistaken_clues_prompt()
+
+    cache_args = {}
+
+    async def agenerate():
+        return await agenerate_json(prompt, Clues)
+
+    return await acached_generation("generate_mistaken_clues", cache_args, agenerate)
+
+# %% carmen.ipynb 54
+def get_arrest_clues_prompt(suspect_name: str) -> str:
+    return f"""
         System: You are the game master for a detective game like "where in the world is Carmen San Diego". 
         User: Generate 3 clues. To generate each clue, do the following 
         1. Pick 3 locations at random out of {clue_locations}. 
@@ -377,16 +2271,530 @@ def generate_arrest_clues(suspect_name: str) -> str:
 
         Assistant:
     """
-    return get_generation_llm().invoke(prompt).content
 
-# %% carmen.ipynb 36
+@tool
+def generate_arrest_clues(suspect_name: str) -> str:
+    """ Generate arrest clues given the name of the suspect"""
+    prompt = get_arrest_clues_prompt(suspect_name)
+
+    cache_args = {"suspect_name": suspect_name}
+
+    return cached_generation("generate_arrest_clues", cache_args, lambda: generate_json(prompt, Clues))
+
+async def agenerate_arrest_clues(suspect_name: str) -> str:
+    prompt = get_arrest_clues_prompt(suspect_name)
+
+    cache_args = {"suspect_name": suspect_name}
+
+    async def agenerate():
+        return await agenerate_json(prompt, Clues)
+
+    return await acached_generation("generate_arrest_clues", cache_args, agenerate)
+
+# %% carmen.ipynb 56
+def get_next_city(game_state: dict) -> str:
+    """ Returns the city at index next_hop in the hops list or "" once the suspect has been caught up with """
+    next_hop = game_state["next_hop"]
+    if next_hop > MAX_HOPS:
+        return ""
+
+    return game_state["hops"][next_hop]
+
+def get_previous_city(game_state: dict) -> str:
+    """ Returns the city at index next_hop - 1 in the hops list, or "" if the player is already there """
+    next_hop = game_state["next_hop"]
+    if next_hop == 1:
+        return ""
+
+    previous_city = game_state["hops"][next_hop - 1]
+    if previous_city == game_state["current_city"]:
+        return ""
+
+    return previous_city
+
+def get_exclude_list(game_state: dict) -> list:
+    """ Returns the cities in the hops list that must not be offered as destinations """
+    allowed = [get_previous_city(game_state), get_next_city(game_state)]
+
+    return [city for city in game_state["hops"] if city not in allowed]
+
+def get_clue_type(game_state: dict) -> str:
+    """ Returns the type of clues to generate: arrest, mistaken or regular """
+    if game_state["next_hop"] == MAX_HOPS + 1:
+        return "arrest"
+    elif game_state["current_city"] not in game_state["hops"]:
+        return "mistaken"
+    else:
+        return "regular"
+
+def get_travel_update(game_state: dict, city: str):
+    """ Returns the game state fields to update when traveling to city or None if the player cannot travel there """
+    hops = game_state["hops"]
+    if city not in hops:
+        return {"current_city": city}
+
+    index = hops.index(city)
+    if index <= game_state["next_hop"]:
+        return {"current_city": city, "next_hop": index + 1}
+
+    return None
+
+def _city_key(city: str) -> str:
+    return " ".join(city.split()).casefold()
+
+def repair_destinations(destinations: list, previous_city: str, next_city: str, current_city: str, exclude_list: str) -> list:
+    """ Returns 4 destinations with the previous and next cities and without the current or excluded cities.
+
+    Takes the arguments of generate_destinations. Cities the model dropped are added back and decoys it got wrong
+    are replaced with famous cities, so every hop can be completed whatever the model returned. The list is shuffled
+    so the position of a city doesn't give away the right answer.
+    """
+    required = [city for city in [previous_city, next_city] if city]
+    excluded = [current_city] + exclude_list.split(",") + required
+    excluded_keys = {_city_key(city) for city in excluded if city}
+
+    decoys = []
+    for city in destinations:
+        if isinstance(city, str) and city.strip() and _city_key(city) not in excluded_keys:
+            excluded_keys.add(_city_key(city))
+            decoys.append(city.strip())
+
+    missing = 4 - len(required) - len(decoys)
+    if missing > 0:
+        candidates = [city for city in famous_cities if _city_key(city) not in excluded_keys]
+        decoys += random.sample(candidates, min(missing, len(candidates)))
+
+    destinations = required + decoys[:4 - len(required)]
+    random.shuffle(destinations)
+
+    return destinations
+
+# %% carmen.ipynb 57
+def get_hop_content(game_state: dict):
+    """ Returns the pre-generated clues and destinations for next_hop if there are any for the player's city """
+    next_hop = game_state["next_hop"]
+    hop_content = game_state.get("hop_content", {})
+    content = hop_content.get(str(next_hop))
+    if content is None:
+        return None
+
+    clue_type = get_clue_type(game_state)
+    if clue_type == "arrest" or game_state["current_city"] == game_state["hops"][next_hop - 1]:
+        return content
+
+    # Games generated with all of their hop content can also send the player back from a wrong city
+    if clue_type == "mistaken" and "mistaken" in hop_content and "decoys" in content:
+        cities = [city for city in [get_previous_city(game_state), get_next_city(game_state)] if city]
+        decoys = [city for city in content["decoys"] if city != game_state["current_city"]]
+
+        return {"clues": hop_content["mistaken"]["clues"], "destinations": (cities + decoys)[:4]}
+
+    return None
+
+def _get_hop_state(game_state: dict, hop: int) -> dict:
+    return dict(game_state, current_city=game_state["hops"][hop - 1], next_hop=hop)
+
+def _get_decoys(game_state: dict, destinations: list) -> list:
+    return [city for city in dict.fromkeys(destinations) if city and city not in game_state["hops"]]
+
+def generate_hop_content(game_state: dict, hop: int) -> dict:
+    """ Generates the clues and destinations for a player in the right city before the given hop """
+    hop_state = _get_hop_state(game_state, hop)
+
+    if get_clue_type(hop_state) == "arrest":
+        clues_json = generate_arrest_clues.invoke({"suspect_name": game_state["suspect_name"]})
+        destinations = []
+    else:
+        clues_json = generate_regular_clues.invoke({"city": get_next_city(hop_state)})
+        destinations = json.loads(generate_destinations.invoke(get_destinations_args(hop_state)))["destinations"]
+
+    return {"clues": json.loads(clues_json)["clues"], "destinations": destinations, "decoys": _get_decoys(game_state, destinations)}
+
+async def agenerate_hop_content(game_state: dict, hop: int) -> dict:
+    hop_state = _get_hop_state(game_state, hop)
+
+    if get_clue_type(hop_state) == "arrest":
+        clues_json = await agenerate_arrest_clues(game_state["suspect_name"])
+        destinations = []
+    else:
+        clues_json, dests_json = await asyncio.gather(
+            agenerate_regular_clues(get_next_city(hop_state)),
+            agenerate_destinations(**get_destinations_args(hop_state))
+        )
+        destinations = json.loads(dests_json)["destinations"]
+
+    return {"clues": json.loads(clues_json)["clues"], "destinations": destinations, "decoys": _get_decoys(game_state, destinations)}
+
+def get_game_content_prompt(game_state: dict) -> str:
+    # Cities with facts get their clues without the llm, so clues are only asked for the other cities
+    clue_cities = [city for city in game_state["hops"][1:] if get_city_facts(city) is None]
+
+    clues_request = ""
+    clues_example = ""
+    if clue_cities:
+        clues_request = f"""3. clues, only for the cities in {clue_cities}: 3 clues. Pick 3 locations from 
+        {clue_locations} in random order and generate a clue about the city for each of them. The clue for a bank 
+        should be the currency of the country, the clue for the embassy should be about the flag of the country, the 
+        clue for the restaurant should be a food from the country, the clue for the Tourism Desk should be about a 
+        famous tourist attraction in the city and the clue for the library should be about a famous author from the 
+        country. Leave clues out for every other city."""
+        clues_example = """
+                    "clues": [
+                        {
+                            "location": <location 1>,
+                            "clue": <clue 1>
+                        }
+                    ],"""
+
+    return f"""
+        System: You are the game master for a detective game like "where in the world is Carmen San Diego". 
+        User: The suspect {game_state["suspect_name"]} travels through these cities in order: {game_state["hops"]}.
+        For each of these cities except the first one generate:
+        1. city: the name of the city
+        2. decoys: a list of 4 cities from {famous_cities} that are not in the list of cities the suspect travels through
+        {clues_request}
+
+        Also generate:
+        1. arrest_clues: 3 clues. Pick 3 locations at random out of {clue_locations}. For two of them set the clue 
+        to "Watch your step. You are getting close". For the third, set the clue to "Congratulations! You have 
+        arrested the suspect, {game_state["suspect_name"]}"
+        2. mistaken_clues: 3 clues. Pick 3 locations at random out of {clue_locations} and set each clue to 
+        "No one with the suspect's description was seen here"
+
+        Here is an example of the output json format:
+        {{
+            "hops": [
+                {{
+                    "city": <city 1>,{clues_example}
+                    "decoys": [<decoy 1>, <decoy 2>, <decoy 3>, <decoy 4>]
+                }}
+            ],
+            "arrest_clues": [
+                {{
+                    "location": <location 1>,
+                    "clue": <clue 1>
+                }}
+            ],
+            "mistaken_clues": [
+                {{
+                    "location": <location 1>,
+                    "clue": <clue 1>
+                }}
+            ]
+        }}
+
+        Output only the json hash. Do not provide any other text output or additional formatting.
+
+        Assistant:
+    """
+
+def build_batched_hop_content(game_state: dict, content: dict) -> dict:
+    """ Turns the reply to get_game_content_prompt into the hop content stored with the game state """
+    hops = game_state["hops"]
+    if [hop["city"] for hop in content["hops"]] != hops[1:]:
+        raise Exception(f"Hop content does not match the hops {hops}")
+
+    hop_content = {}
+    for hop, hop_item in enumerate(content["hops"], start=1):
+        city = hops[hop]
+        # One spare decoy so a player who travels to a wrong city can still be offered 4 destinations
+        decoys = _get_decoys(game_state, hop_item["decoys"])[:4]
+        if len(decoys) < 3:
+            raise Exception(f"Not enough decoy cities for {city}: {hop_item['decoys']}")
+
+        # Cities with facts get the same clues as the lazy path, without another llm call
+        if get_city_facts(city) is not None:
+            clues = json.loads(generate_regular_clues.invoke({"city": city}))["clues"]
+        elif hop_item.get("clues"):
+            clues = hop_item["clues"]
+        else:
+            raise Exception(f"No clues for {city}, which has no facts")
+
+        hop_content[str(hop)] = {"clues": clues, "destinations": [city] + decoys[:3], "decoys": decoys}
+
+    hop_content[str(MAX_HOPS + 1)] = {"clues": content["arrest_clues"], "destinations": []}
+    hop_content["mistaken"] = {"clues": content["mistaken_clues"]}
+
+    return hop_content
+
+def generate_game_content(game_state: dict) -> dict:
+    """ Generates the hop content for every hop of a game, either in one batched request or a request per hop """
+    if HOP_CONTENT_GENERATION == "batch":
+        content = json.loads(generate_json(get_game_content_prompt(game_state), GameContent))
+        return build_batched_hop_content(game_state, content)
+    elif HOP_CONTENT_GENERATION == "parallel":
+        hops = range(1, MAX_HOPS + 2)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(hops) + 1) as executor:
+            # Copy the context so spans and tool caches follow the work into the threads
+            futures = [executor.submit(contextvars.copy_context().run, generate_hop_content, game_state, hop) for hop in hops]
+            mistaken = executor.submit(contextvars.copy_context().run, generate_mistaken_clues.invoke, {})
+
+            hop_content = {str(hop): future.result() for hop, future in zip(hops, futures)}
+            hop_content["mistaken"] = {"clues": json.loads(mistaken.result())["clues"]}
+
+        return hop_content
+    else:
+        raise Exception(f"Unknown hop content generation: {HOP_CONTENT_GENERATION}")
+
+async def agenerate_game_content(game_state: dict) -> dict:
+    if HOP_CONTENT_GENERATION == "batch":
+        content = json.loads(await agenerate_json(get_game_content_prompt(game_state), GameContent))
+        return build_batched_hop_content(game_state, content)
+    elif HOP_CONTENT_GENERATION == "parallel":
+        hops = range(1, MAX_HOPS + 2)
+        *contents, mistaken_json = await asyncio.gather(
+            *(agenerate_hop_content(game_state, hop) for hop in hops),
+            agenerate_mistaken_clues()
+        )
+
+        hop_content = {str(hop): content for hop, content in zip(hops, contents)}
+        hop_content["mistaken"] = {"clues": json.loads(mistaken_json)["clues"]}
+
+        return hop_content
+    else:
+        raise Exception(f"Unknown hop content generation: {HOP_CONTENT_GENERATION}")
+
+@retry(stop_max_delay=60000, stop_max_attempt_number=3)
+def generate_pooled_game(prefetch_first_hop: bool = GAME_POOL_PREFETCH_FIRST_HOP) -> dict:
+    game_state = json.loads(generate_new_game())
+    validate_game_state(game_state)
+
+    if HOP_CONTENT_GENERATION != "lazy":
+        game_state["hop_content"] = generate_game_content(game_state)
+    elif prefetch_first_hop:
+        game_state["hop_content"] = {"1": generate_hop_content(game_state, 1)}
+
+    return game_state
+
+def refill_game_pool(depth: int = GAME_POOL_DEPTH) -> int:
+    """ Tops up the pool of pre-generated games for the current provider and returns how many were added """
+    r = get_redis_connection()
+    key = get_game_pool_key()
+
+    # Every worker process runs a refiller, only one at a time tops up the pool so they don't overshoot the depth
+    lock = r.lock(f"{key}:refill", timeout=GAME_POOL_REFILL_LOCK_TIMEOUT, blocking=False)
+    if not lock.acquire():
+        return 0
+
+    added = 0
+    try:
+        while r.llen(key) < depth:
+            r.rpush(key, dump_game_state(generate_pooled_game()))
+            added += 1
+            lock.reacquire()
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            logger.warning("The game pool refill lock expired before the refill finished")
+
+    return added
+
+def start_game_pool_refiller(depth: int = GAME_POOL_DEPTH, interval: float = GAME_POOL_REFILL_INTERVAL):
+    """ Keeps the game pool topped up from a background thread until the returned event is set """
+    stop = threading.Event()
+
+    def refill():
+        while not stop.is_set():
+            try:
+                refill_game_pool(depth)
+            except Exception:
+                logger.exception("Failed to refill the game pool")
+
+            stop.wait(interval)
+
+    threading.Thread(target=refill, name="game-pool-refiller", daemon=True).start()
+
+    return stop
+
+# %% carmen.ipynb 60
+def get_sandbox_prelude() -> str:
+    """ Source run by every sandbox worker before its first snippet, defining the names snippets can use """
+    helpers = [get_next_city, get_previous_city, get_exclude_list, get_clue_type, get_travel_update]
+
+    return "\n\n".join(["import json", f"MAX_HOPS = {MAX_HOPS}"] + [inspect.getsource(helper) for helper in helpers])
+
+class _SandboxWorker:
+    def __init__(self, process):
+        self.process = process
+        self.buffer = b""
+
+class PythonSandbox:
+    """ Pool of isolated worker processes that run agent written python.
+
+    Workers are fresh interpreters running python_sandbox.py with an empty environment and no inherited file
+    descriptors. They lock themselves down with rlimits, landlock and a seccomp filter that blocks networking and
+    process creation. Each snippet runs in a fresh namespace with get_sandbox_prelude() and the variables passed to
+    run. Workers that time out or hit a limit are killed and replaced, so a runaway snippet never blocks the server.
+    """
+    # Seconds a new worker has to start the interpreter and lock itself down
+    start_timeout = 10
+    # Seconds run waits for a free worker before failing the tool call
+    wait_timeout = 30
+
+    def __init__(self, workers: int = PYTHON_SANDBOX_WORKERS, timeout: float = PYTHON_SANDBOX_TIMEOUT):
+        self.timeout = timeout
+        self.prelude = get_sandbox_prelude()
+        self.idle = queue.Queue()
+        self.workers = set()
+        self.lock = threading.Lock()
+        self.warned = False
+
+        for _ in range(workers):
+            self.idle.put(self._start_worker())
+
+    def _start_worker(self):
+        process = subprocess.Popen(
+            [sys.executable, "-I", "-S", python_sandbox.__file__],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            env={},
+            cwd="/",
+            close_fds=True,
+        )
+        worker = _SandboxWorker(process)
+
+        config = {"prelude": self.prelude, "memory_mb": PYTHON_SANDBOX_MEMORY_MB, "cpu_seconds": PYTHON_SANDBOX_CPU_SECONDS}
+        try:
+            self._send(worker, config)
+            reply = self._receive(worker, time.monotonic() + self.start_timeout)
+        except (EOFError, OSError):
+            reply = None
+
+        if reply is None or "error" in reply:
+            self._stop_worker(worker)
+            error = reply["error"] if reply is not None else "the worker exited or did not answer"
+            raise Exception(f"Could not start a python sandbox worker: {error}")
+
+        if not reply["landlock"] and not self.warned:
+            logger.warning("Landlock is not available, sandboxed python can read any file the server can")
+            self.warned = True
+
+        with self.lock:
+            self.workers.add(worker)
+
+        return worker
+
+    def _stop_worker(self, worker):
+        worker.process.kill()
+        worker.process.wait()
+        worker.process.stdin.close()
+        worker.process.stdout.close()
+
+    def _replace_worker(self, worker):
+        self._stop_worker(worker)
+
+        with self.lock:
+            self.workers.discard(worker)
+
+        # The slot goes back to the pool even if no new worker starts, run retries the start when it takes the slot
+        try:
+            worker = self._start_worker()
+        except Exception:
+            logger.exception("Could not replace a python sandbox worker")
+            worker = None
+
+        self.idle.put(worker)
+
+    def _send(self, worker, message: dict):
+        worker.process.stdin.write(json.dumps(message).encode() + b"\n")
+        worker.process.stdin.flush()
+
+    def _receive(self, worker, deadline: float, request_id: str = None):
+        """ Returns the worker's reply to request_id or None if it didn't arrive before the deadline """
+        fd = worker.process.stdout.fileno()
+
+        while True:
+            while b"\n" in worker.buffer:
+                line, worker.buffer = worker.buffer.split(b"\n", 1)
+                try:
+                    reply = json.loads(line)
+                except ValueError:
+                    continue
+
+                # Snippets can find the worker's reply pipe, so anything without the random id of this run is dropped
+                if isinstance(reply, dict) and reply.get("id") == request_id:
+                    return reply
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                return None
+
+            data = os.read(fd, 65536)
+            if not data:
+                raise EOFError("The sandbox worker exited")
+
+            worker.buffer += data
+
+    def run(self, code: str, variables: dict = None) -> str:
+        try:
+            worker = self.idle.get(timeout=self.wait_timeout)
+        except queue.Empty:
+            raise ToolException(f"No python sandbox worker became free within {self.wait_timeout} seconds")
+
+        if worker is None:
+            try:
+                worker = self._start_worker()
+            except Exception as e:
+                self.idle.put(None)
+                raise ToolException(str(e))
+
+        request_id = uuid.uuid4().hex
+
+        try:
+            self._send(worker, {"id": request_id, "code": code, "variables": variables or {}})
+            reply = self._receive(worker, time.monotonic() + self.timeout, request_id)
+            if reply is not None:
+                self.idle.put(worker)
+                return reply["output"]
+
+            error = f"TimeoutError('The code did not finish within {self.timeout} seconds')"
+        except (EOFError, OSError):
+            error = "MemoryError('The code exceeded the cpu or memory limit of the sandbox')"
+
+        metrics.inc("carmen_python_sandbox_restarts_total")
+        self._replace_worker(worker)
+
+        return error
+
+    def close(self):
+        with self.lock:
+            workers = list(self.workers)
+            self.workers.clear()
+
+        for worker in workers:
+            self._stop_worker(worker)
+
+@functools.lru_cache(maxsize=None)
+def get_python_sandbox() -> PythonSandbox:
+    return PythonSandbox()
+
+_python_repl = PythonREPL()
+
+def run_python(command: str) -> str:
+    cache = _tool_cache.get()
+
+    if PYTHON_EXECUTION == "sandbox":
+        variables = {"game_states": cache.get_game_states() if cache is not None else {}}
+        return cached_tool_call("python_repl", command, lambda: get_python_sandbox().run(command, variables))
+    elif PYTHON_EXECUTION == "inprocess":
+        # A snippet that wasn't cached may change the repl's globals so earlier snippets could print something else now
+        if cache is not None and ("python_repl", command) not in cache.values:
+            cache.invalidate("python_repl")
+
+        return cached_tool_call("python_repl", command, lambda: _python_repl.run(command))
+    else:
+        raise Exception(f"Unknown python execution: {PYTHON_EXECUTION}")
+
 python_repl = Tool(
     name="python_repl",
-    description="A Python shell. Use this to execute python commands. Input should be a valid python command. If you want to see the output of a value, you should print it out with `print(...)`.",
-    func=PythonREPL().run,
+    description="A Python shell. Use this to execute python commands. Input should be a valid python command. If you want to see the output of a value, you should print it out with `print(...)`. Game states fetched with fetch_game_state are available as parsed dicts in `game_states[case_id]`, along with the helpers get_next_city, get_previous_city, get_exclude_list, get_clue_type and get_travel_update that take a game state.",
+    func=run_python,
+    handle_tool_error=True,
 )
 
-# %% carmen.ipynb 37
+# %% carmen.ipynb 61
 tools = [
     fetch_game_state, 
     generate_destinations, 
@@ -397,8 +2805,94 @@ tools = [
     update_game_state,   
 ]
 
-# %% carmen.ipynb 38
-def get_agent_executor():
+# Tools are timed whether the agent or the rules engine calls them
+tool_metrics_handler = ToolMetricsHandler()
+for t in tools:
+    t.callbacks = [tool_metrics_handler]
+
+# %% carmen.ipynb 62
+@functools.lru_cache(maxsize=None)
+def get_tool_executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=AGENT_TOOL_WORKERS, thread_name_prefix="agent-tool")
+
+class ToolBarrier:
+    """ Orders the tool calls of one async agent run, which AgentExecutor gathers all at once.
+
+    A sequential call waits for every call started before it, and calls started after it wait for it to finish.
+    """
+    def __init__(self):
+        self.running = []
+        self.sequential = None
+
+    async def run(self, sequential: bool, coroutine):
+        done = asyncio.get_running_loop().create_future()
+
+        # Calls are registered in the order the gathered coroutines start, which is the order of the actions
+        if sequential:
+            waiting_for, self.running, self.sequential = self.running, [done], done
+        else:
+            waiting_for = [self.sequential] if self.sequential is not None else []
+            self.running.append(done)
+
+        try:
+            await asyncio.gather(*waiting_for)
+            return await coroutine
+        finally:
+            coroutine.close()
+            done.set_result(None)
+
+# Set for the duration of ainvoke_agent
+_tool_barrier = contextvars.ContextVar("tool_barrier", default=None)
+
+class ParallelAgentExecutor(AgentExecutor):
+    """ Runs the tool calls the model makes in a single turn concurrently, keeping their order in the transcript.
+
+    invoke runs them on a thread pool and ainvoke gathers them, both wait for sequential tools as barriers.
+    """
+    # The repl redirects stdout while it runs. Game state writes must not race the reads around them or the tool cache
+    # could keep a state fetched before the write. So these wait for the other tools and run on their own.
+    sequential_tools: List[str] = ["python_repl", "update_game_state", "set_current_city"]
+
+    def _iter_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager=None):
+        actions, futures = [], []
+
+        for item in super()._iter_next_step(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager):
+            if isinstance(item, concurrent.futures.Future):
+                futures.append(item)
+            else:
+                if isinstance(item, AgentAction):
+                    actions.append(item)
+                yield item
+
+            # The next iteration performs actions[len(futures)]
+            if len(futures) < len(actions) and actions[len(futures)].tool in self.sequential_tools:
+                concurrent.futures.wait(futures)
+
+        for future in futures:
+            yield future.result()
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        perform = functools.partial(super()._perform_agent_action, name_to_tool_map, color_mapping, agent_action, run_manager)
+
+        if agent_action.tool in self.sequential_tools:
+            future = concurrent.futures.Future()
+            future.set_result(perform())
+            return future
+
+        # Copy the context so the tool cache and request spans follow the call into the pool
+        return get_tool_executor().submit(contextvars.copy_context().run, perform)
+
+    async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+        perform = super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+
+        barrier = _tool_barrier.get()
+        if barrier is None:
+            return await perform
+
+        return await barrier.run(agent_action.tool in self.sequential_tools, perform)
+
+@functools.lru_cache(maxsize=None)
+def _build_agent_executor(provider):
     prompt = ChatPromptTemplate.from_messages(
         [
           ("system", "You are the game master for a detective game like 'where in the world is Carmen San Diego'. You will have to make a lot of decisions so look at the clues carefully."),
@@ -408,21 +2902,64 @@ def get_agent_executor():
         ]
     )
 
-    llm = get_agent_llm()
+    llm = get_llm(provider, "agent")
     # Construct the tool calling agent
     agent = create_tool_calling_agent(llm, tools, prompt)
 
+    if AGENT_EXECUTOR_MODE == "parallel":
+        executor_class = ParallelAgentExecutor
+    elif AGENT_EXECUTOR_MODE == "sequential":
+        executor_class = AgentExecutor
+    else:
+        raise Exception(f"Unknown agent executor mode: {AGENT_EXECUTOR_MODE}")
+
     # Create an agent executor by passing in the agent and tools
-    agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+    agent_executor = executor_class(agent=agent, tools=tools, verbose=True)
 
     return agent_executor
 
-# %% carmen.ipynb 39
-@retry(stop_max_delay=15000, stop_max_attempt_number=3)
-def get_destinations(case_id):
-    agent_executor = get_agent_executor()
-    
-    prompt = f"""
+def get_agent_executor():
+    # The executor holds no per-run state so one instance per provider is shared by all requests and retries
+    return _build_agent_executor(model_provider)
+
+def invoke_agent(prompt: str) -> dict:
+    """ Runs the agent with a fresh tool cache and adds the cache hit counts to the result under tool_cache """
+    cache = ToolCache()
+    token = _tool_cache.set(cache)
+    try:
+        with span("agent", model_provider):
+            ret = get_agent_executor().invoke({"input": prompt})
+    finally:
+        _tool_cache.reset(token)
+
+    ret["tool_cache"] = cache.stats()
+    metrics.inc("carmen_tool_cache_hits_total", cache.hits)
+    metrics.inc("carmen_tool_cache_misses_total", cache.misses)
+    logger.info(f"Agent run tool cache: {ret['tool_cache']}")
+
+    return ret
+
+async def ainvoke_agent(prompt: str) -> dict:
+    cache = ToolCache()
+    token = _tool_cache.set(cache)
+    barrier_token = _tool_barrier.set(ToolBarrier())
+    try:
+        with span("agent", model_provider):
+            ret = await get_agent_executor().ainvoke({"input": prompt})
+    finally:
+        _tool_barrier.reset(barrier_token)
+        _tool_cache.reset(token)
+
+    ret["tool_cache"] = cache.stats()
+    metrics.inc("carmen_tool_cache_hits_total", cache.hits)
+    metrics.inc("carmen_tool_cache_misses_total", cache.misses)
+    logger.info(f"Agent run tool cache: {ret['tool_cache']}")
+
+    return ret
+
+# %% carmen.ipynb 63
+def get_destinations_agent_prompt(case_id):
+    return f"""
     Do the following:
     1. Fetch the game state for case_id {case_id}
     2. Write python code passing in the game state to do the following:
@@ -454,20 +2991,85 @@ def get_destinations(case_id):
             
     Generate no additional text or additional formatting.
     """
-    ret = agent_executor.invoke(
-        {
-            "input": prompt
-        }
-    )
 
-    return json.loads(ret['output'])
+@retry(stop_max_delay=15000, stop_max_attempt_number=3)
+def get_destinations_with_agent(case_id):
+    ret = invoke_agent(get_destinations_agent_prompt(case_id))
+
+    return parse_agent_output(ret['output'], Destinations)
+
+@aretry(stop_max_delay=15000, stop_max_attempt_number=3)
+async def aget_destinations_with_agent(case_id):
+    ret = await ainvoke_agent(get_destinations_agent_prompt(case_id))
+
+    return await aparse_agent_output(ret['output'], Destinations)
+
+# %% carmen.ipynb 64
+def get_destinations_args(game_state: dict) -> dict:
+    """ Returns the arguments for generate_destinations given the game state """
+    return {
+        "previous_city": get_previous_city(game_state),
+        "next_city": get_next_city(game_state),
+        "current_city": game_state["current_city"],
+        "exclude_list": ",".join(get_exclude_list(game_state))
+    }
+
+def get_destinations_response(game_state: dict, destinations: list) -> dict:
+    # Also repairs variants cached before destinations were checked and hop content generated for another city
+    destinations = repair_destinations(destinations, **get_destinations_args(game_state))
+    random.shuffle(destinations)
+
+    return {"city": game_state["current_city"], "destinations": destinations}
 
-# %% carmen.ipynb 41
 @retry(stop_max_delay=15000, stop_max_attempt_number=3)
-def get_clues(case_id):
-    agent_executor = get_agent_executor()
-    
-    prompt = f"""
+def get_destinations_with_rules(case_id):
+    game_state = get_game_state(case_id)
+
+    if game_state["next_hop"] == MAX_HOPS + 1:
+        return {"city": game_state["current_city"], "destinations": []}
+
+    content = get_hop_content(game_state)
+    if content is not None:
+        return get_destinations_response(game_state, content["destinations"])
+
+    dests_json = generate_destinations.invoke(get_destinations_args(game_state))
+
+    return get_destinations_response(game_state, json.loads(dests_json)["destinations"])
+
+@aretry(stop_max_delay=15000, stop_max_attempt_number=3)
+async def aget_destinations_with_rules(case_id):
+    game_state = await aget_game_state(case_id)
+
+    if game_state["next_hop"] == MAX_HOPS + 1:
+        return {"city": game_state["current_city"], "destinations": []}
+
+    content = get_hop_content(game_state)
+    if content is not None:
+        return get_destinations_response(game_state, content["destinations"])
+
+    dests_json = await agenerate_destinations(**get_destinations_args(game_state))
+
+    return get_destinations_response(game_state, json.loads(dests_json)["destinations"])
+
+def get_destinations(case_id):
+    if ENGINE_MODE == "rules":
+        return get_destinations_with_rules(case_id)
+    elif ENGINE_MODE == "agent":
+        return get_destinations_with_agent(case_id)
+    else:
+        raise Exception(f"Unknown engine mode: {ENGINE_MODE}")
+
+async def aget_destinations(case_id):
+    if ENGINE_MODE == "rules":
+        return await aget_destinations_with_rules(case_id)
+    elif ENGINE_MODE == "agent":
+        return await aget_destinations_with_agent(case_id)
+    else:
+        raise Exception(f"Unknown engine mode: {ENGINE_MODE}")
+
+# %% carmen.ipynb 66
+def get_clues_agent_prompt(case_id):
+    return f"""
     1. Fetch the game state for case_id {case_id}.
     2. Write and execute python code passing in the game state to do the following to figure out what kind of 
        clue to generate:
@@ -480,20 +3082,75 @@ def get_clues(case_id):
     Return the output exactly as a hash encoded in json returned from the tool. Generate no additional text or
     additional formatting.
     """
-    ret = agent_executor.invoke(
-        {
-            "input": prompt
-        }
-    )
 
-    return json.loads(ret['output'])
+@retry(stop_max_delay=15000, stop_max_attempt_number=3)
+def get_clues_with_agent(case_id):
+    ret = invoke_agent(get_clues_agent_prompt(case_id))
+
+    return parse_agent_output(ret['output'], Clues)
+
+@aretry(stop_max_delay=15000, stop_max_attempt_number=3)
+async def aget_clues_with_agent(case_id):
+    ret = await ainvoke_agent(get_clues_agent_prompt(case_id))
 
-# %% carmen.ipynb 45
+    return await aparse_agent_output(ret['output'], Clues)
+
+# %% carmen.ipynb 67
 @retry(stop_max_delay=15000, stop_max_attempt_number=3)
-def travel(case_id, city):
-    agent_executor = get_agent_executor()
-    
-    prompt = f"""
+def get_clues_with_rules(case_id):
+    game_state = get_game_state(case_id)
+    clue_type = get_clue_type(game_state)
+
+    content = get_hop_content(game_state)
+    if content is not None:
+        return {"clues": content["clues"]}
+
+    if clue_type == "arrest":
+        clues_json = generate_arrest_clues.invoke({"suspect_name": game_state["suspect_name"]})
+    elif clue_type == "mistaken":
+        clues_json = generate_mistaken_clues.invoke({})
+    else:
+        clues_json = generate_regular_clues.invoke({"city": get_next_city(game_state)})
+
+    return json.loads(clues_json)
+
+@aretry(stop_max_delay=15000, stop_max_attempt_number=3)
+async def aget_clues_with_rules(case_id):
+    game_state = await aget_game_state(case_id)
+    clue_type = get_clue_type(game_state)
+
+    content = get_hop_content(game_state)
+    if content is not None:
+        return {"clues": content["clues"]}
+
+    if clue_type == "arrest":
+        clues_json = await agenerate_arrest_clues(game_state["suspect_name"])
+    elif clue_type == "mistaken":
+        clues_json = await agenerate_mistaken_clues()
+    else:
+        clues_json = await agenerate_regular_clues(get_next_city(game_state))
+
+    return json.loads(clues_json)
+
+def get_clues(case_id):
+    if ENGINE_MODE == "rules":
+        return get_clues_with_rules(case_id)
+    elif ENGINE_MODE == "agent":
+        return get_clues_with_agent(case_id)
+    else:
+        raise Exception(f"Unknown engine mode: {ENGINE_MODE}")
+
+async def aget_clues(case_id):
+    if ENGINE_MODE == "rules":
+        return await aget_clues_with_rules(case_id)
+    elif ENGINE_MODE == "agent":
+        return await aget_clues_with_agent(case_id)
+    else:
+        raise Exception(f"Unknown engine mode: {ENGINE_MODE}")
+
+# %% carmen.ipynb 71
+def get_travel_agent_prompt(case_id, city):
+    return f"""
         1. Fetch the game state for case_id {case_id}
         2. Write python code passing in the game state to do the following:
             a. If {city} is not in the hops list, update current_city to {city} and print out the 
@@ -526,11 +3183,158 @@ def travel(case_id, city):
 
     """
 
-    ret = agent_executor.invoke(
-        {
-            "input": prompt
-        }
-    )
+@retry(stop_max_delay=15000, stop_max_attempt_number=3)
+def travel_with_agent(case_id, city):
+    ret = invoke_agent(get_travel_agent_prompt(case_id, city))
 
-    return json.loads(ret['output'])
-    
+    return parse_agent_output(ret['output'], TravelResult)
+
+@aretry(stop_max_delay=15000, stop_max_attempt_number=3)
+async def atravel_with_agent(case_id, city):
+    ret = await ainvoke_agent(get_travel_agent_prompt(case_id, city))
+
+    return await aparse_agent_output(ret['output'], TravelResult)
+
+# %% carmen.ipynb 72
+def travel_with_rules(case_id, city):
+    game_state = get_game_state(case_id)
+    update = get_travel_update(game_state, city)
+
+    if update is None:
+        return {"error": "You cannot travel to that city"}
+
+    update_game_state_fields(case_id, update)
+
+    return {"current_city": city}
+
+async def atravel_with_rules(case_id, city):
+    game_state = await aget_game_state(case_id)
+    update = get_travel_update(game_state, city)
+
+    if update is None:
+        return {"error": "You cannot travel to that city"}
+
+    await aupdate_game_state_fields(case_id, update)
+
+    return {"current_city": city}
+
+def travel(case_id, city):
+    if ENGINE_MODE == "rules":
+        return travel_with_rules(case_id, city)
+    elif ENGINE_MODE == "agent":
+        return travel_with_agent(case_id, city)
+    else:
+        raise Exception(f"Unknown engine mode: {ENGINE_MODE}")
+
+async def atravel(case_id, city):
+    if ENGINE_MODE == "rules":
+        return await atravel_with_rules(case_id, city)
+    elif ENGINE_MODE == "agent":
+        return await atravel_with_agent(case_id, city)
+    else:
+        raise Exception(f"Unknown engine mode: {ENGINE_MODE}")
+
+# %% carmen.ipynb 73
+@aretry(stop_max_delay=15000, stop_max_attempt_number=3)
+async def _agenerate_valid_game_state() -> dict:
+    game_state = json.loads(await agenerate_new_game())
+    validate_game_state(game_state)
+
+    return game_state
+
+async def astream_new_game():
+    """ Yields the fields of a new game as they are generated, case_id comes last once the game is stored.
+
+    If the streamed game doesn't parse or validate, the game is generated again like anew_game does and the fields
+    that changed are yielded again.
+    """
+    intro_fields = ["suspect_name", "current_city", "stolen_item"]
+
+    game_state = await apop_pooled_game()
+    if game_state is None:
+        streamed = {}
+        parser = JsonStreamParser()
+
+        async for text in astream_generation(get_new_game_prompt()):
+            for kind, value in parser.feed(text):
+                if kind == "member":
+                    key, value = value
+                    streamed[key] = value
+                    if key in intro_fields:
+                        yield {key: value}
+
+        try:
+            if parser.malformed:
+                raise ValueError("The streamed game is not valid json")
+
+            game_state = GameState.model_validate(streamed).model_dump()
+            validate_game_state(game_state)
+        except Exception as e:
+            logger.warning(f"Streamed game was malformed, generating it without streaming: {e}")
+            game_state = await _agenerate_valid_game_state()
+
+            for field in intro_fields:
+                if streamed.get(field) != game_state[field]:
+                    yield {field: game_state[field]}
+
+        if HOP_CONTENT_GENERATION != "lazy":
+            game_state["hop_content"] = await agenerate_game_content(game_state)
+    else:
+        for field in intro_fields:
+            yield {field: game_state[field]}
+
+    game_state["case_id"] = str(uuid.uuid4())
+    await astore_game_state(game_state)
+
+    yield {"case_id": game_state["case_id"]}
+
+async def _astream_clues_json(clues_json: str):
+    for clue in json.loads(clues_json)["clues"]:
+        yield clue
+
+async def _astream_generated_clues(name: str, args: dict, prompt: str):
+    parser = JsonStreamParser()
+    streamed = 0
+
+    try:
+        async for text in astream_cached_generation(name, args, prompt, Clues):
+            for kind, value in parser.feed(text):
+                if kind == "item" and isinstance(value, dict) and "clue" in value:
+                    streamed += 1
+                    yield value
+    except ValueError as e:
+        # The clues that were already streamed stay, the validated generation fills in the rest
+        logger.warning(f"Streamed {name} output was malformed, generating it without streaming: {e}")
+        clues_json = await acached_generation(name, args, lambda: agenerate_json(prompt, Clues))
+
+        for clue in json.loads(clues_json)["clues"][streamed:]:
+            yield clue
+
+async def astream_clues(case_id):
+    """ Yields each clue for the case as soon as it is available """
+    if ENGINE_MODE == "agent":
+        for clue in (await aget_clues_with_agent(case_id))["clues"]:
+            yield clue
+        return
+
+    game_state = await aget_game_state(case_id)
+    clue_type = get_clue_type(game_state)
+
+    content = get_hop_content(game_state)
+    if content is not None:
+        clues = _astream_clues_json(json.dumps({"clues": content["clues"]}))
+    elif clue_type == "arrest":
+        suspect_name = game_state["suspect_name"]
+        clues = _astream_generated_clues(
+            "generate_arrest_clues", {"suspect_name": suspect_name}, get_arrest_clues_prompt(suspect_name)
+        )
+    elif clue_type == "mistaken":
+        clues = _astream_generated_clues("generate_mistaken_clues", {}, get_mistaken_clues_prompt())
+    elif get_city_facts(get_next_city(game_state)) is not None:
+        clues = _astream_clues_json(await agenerate_regular_clues(get_next_city(game_state)))
+    else:
+        city = get_next_city(game_state)
+        clues = _astream_generated_clues("generate_regular_clues", {"city": city}, get_regular_clues_prompt(city))
+
+    async for clue in clues:
+        yield clue
@@ -1,7 +1,13 @@
 import os
 import unittest
+import unittest.mock
 import json
+import asyncio
+import importlib.util
 
+from langchain_core.tools import ToolException
+
+import carmen_backend
 from carmen_backend import *
 
 class CarmenBackendTest(unittest.TestCase):
@@ -49,6 +55,31 @@ class CarmenBackendTest(unittest.TestCase):
 
         self.assertEqual(ret, {})
 
+    def test_iter_game_states(self):
+        other_game_state = self.game_state.copy()
+        other_game_state["case_id"] = "other-case"
+        other_game_state["next_hop"] = 1
+        store_game_state(other_game_state)
+
+        self.assertEqual(
+            dict(iter_game_states(batch_size=1)),
+            {self.case_id: self.game_state, "other-case": other_game_state}
+        )
+        self.assertEqual(
+            dict(iter_game_states(filter_fn=lambda game_state: game_state["next_hop"] == 1)),
+            {"other-case": other_game_state}
+        )
+
+    def test_clear_game_states_keeps_other_keys(self):
+        r = get_redis_connection()
+        r.set("not-a-game", "value")
+
+        clear_game_states()
+
+        self.assertEqual(get_game_states(), {})
+        self.assertEqual(r.get("not-a-game"), b"value")
+        r.delete("not-a-game")
+
     def test_state_is_loaded_correctly(self):
         ret = get_game_state(self.case_id)
 
@@ -97,6 +128,39 @@ class CarmenBackendTest(unittest.TestCase):
         new_game_state = get_game_state(self.case_id)
         self.assertEqual(new_game_state["next_hop"], 46)
 
+    def test_update_game_state_fields(self):
+        update_game_state_fields(self.case_id, {"current_city": "Cairo", "next_hop": 4})
+
+        self.game_state["current_city"] = "Cairo"
+        self.game_state["next_hop"] = 4
+        self.assertEqual(get_game_state(self.case_id), self.game_state)
+
+    def test_update_game_state_fields_unknown_case(self):
+        with self.assertRaises(Exception):
+            update_game_state_fields("unknown-case", {"next_hop": 4})
+
+        self.assertNotIn("unknown-case", get_game_states())
+
+    def test_cached_generation_keeps_variants(self):
+        get_redis_connection().delete(get_generation_cache_key("test_tool", {"city": "Paris"}))
+        calls = []
+
+        def generate():
+            calls.append(1)
+            return json.dumps({"variant": len(calls)})
+
+        values = [cached_generation("test_tool", {"city": "Paris"}, generate) for _ in range(3 * GENERATION_CACHE_VARIANTS)]
+
+        self.assertEqual(len(calls), GENERATION_CACHE_VARIANTS)
+        self.assertTrue(set(values[GENERATION_CACHE_VARIANTS:]) <= set(values[:GENERATION_CACHE_VARIANTS]))
+
+    def test_cached_generation_skips_malformed_output(self):
+        key = get_generation_cache_key("test_tool", {"city": "Lima"})
+        get_redis_connection().delete(key)
+
+        self.assertEqual(cached_generation("test_tool", {"city": "Lima"}, lambda: "not json"), "not json")
+        self.assertEqual(get_redis_connection().llen(key), 0)
+
     def test_generate_new_game(self):
         game_state = json.loads(generate_new_game())
 
@@ -196,6 +260,54 @@ class CarmenBackendTest(unittest.TestCase):
         self.assertIn("case_id", res)
         self.assertIn("suspect_name", res)
 
+    def test_new_game_uses_pooled_game(self):
+        r = get_redis_connection()
+        pooled_game = self.game_state.copy()
+        pooled_game["current_city"] = "Paris"
+        pooled_game["next_hop"] = 1
+
+        r.delete(get_game_pool_key())
+        r.rpush(get_game_pool_key(), json.dumps(pooled_game))
+
+        res = new_game()
+
+        self.assertEqual(res["suspect_name"], pooled_game["suspect_name"])
+        self.assertEqual(res["current_city"], "Paris")
+        self.assertNotEqual(res["case_id"], pooled_game["case_id"])
+        self.assertEqual(r.llen(get_game_pool_key()), 0)
+
+    def test_clues_and_destinations_from_hop_content(self):
+        hop_content = {
+            "clues": [{"location": "Bank", "clue": "The suspect changed their currency to Yen"}],
+            "destinations": ["Tokyo", "Lima", "Oslo", "Madrid"]
+        }
+        update_game_state_fields(
+            self.case_id,
+            {"current_city": "Cairo", "hop_content": {"3": hop_content}}
+        )
+
+        self.assertEqual(get_clues(self.case_id), {"clues": hop_content["clues"]})
+        self.assertCountEqual(get_destinations(self.case_id)["destinations"], hop_content["destinations"])
+
+    def test_finished_game_is_archived_once_and_keeps_its_ttl(self):
+        import tempfile
+        import concurrent.futures
+
+        for storage in ["hash", "json"]:
+            with tempfile.TemporaryDirectory() as directory, \
+                 unittest.mock.patch.object(carmen_backend, "GAME_STATE_STORAGE", storage), \
+                 unittest.mock.patch.object(carmen_backend, "GAME_ARCHIVE_PATH", os.path.join(directory, "archive.jsonl.gz")):
+                store_game_state(self.game_state)
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                    list(executor.map(lambda _: finish_game(self.case_id), range(8)))
+
+                self.assertEqual(len(list(iter_archived_game_states())), 1, storage)
+
+                update_game_state_fields(self.case_id, {"current_city": "Cairo"})
+                self.assertLessEqual(get_redis_connection().ttl(get_game_key(self.case_id)), GAME_FINISHED_TTL, storage)
+                self.assertTrue(get_game_state(self.case_id)["finished"], storage)
+
     def test_get_destinations(self):
         res = get_destinations(self.case_id)
         dests = res["destinations"]
@@ -332,5 +444,918 @@ class CarmenBackendTest(unittest.TestCase):
             gs["next_hop"],
             self.game_state["next_hop"])
 
+class CarmenAsyncBackendTest(unittest.IsolatedAsyncioTestCase):
+    GAME_STATE = CarmenBackendTest.GAME_STATE
+
+    async def asyncSetUp(self):
+        await astore_game_state(self.GAME_STATE)
+        self.game_state = json.loads(json.dumps(self.GAME_STATE))
+        self.case_id = self.game_state["case_id"]
+
+    async def asyncTearDown(self):
+        clear_game_states()
+        await aclose_redis_connections()
+
+    async def test_aget_game_state(self):
+        self.assertEqual(await aget_game_state(self.case_id), self.game_state)
+
+    async def test_aupdate_game_state_fields(self):
+        await aupdate_game_state_fields(self.case_id, {"next_hop": 4})
+
+        self.assertEqual(get_game_state(self.case_id)["next_hop"], 4)
+
+    async def test_atravel_to_correct_city(self):
+        res = await atravel(self.case_id, "Cairo")
+
+        self.assertEqual(res["current_city"], "Cairo")
+        self.assertEqual(get_game_state(self.case_id)["current_city"], "Cairo")
+
+    async def test_atravel_to_future_city(self):
+        res = await atravel(self.case_id, "New York")
+
+        self.assertEqual(res["error"], "You cannot travel to that city")
+        self.assertEqual(get_game_state(self.case_id), self.game_state)
+
+    async def test_aget_clues_wrong_city(self):
+        clues = (await aget_clues(self.case_id))["clues"]
+
+        self.assertEqual(len(clues), 3)
+        self.assertEqual(clues[0]["clue"], "No one with the suspect's description was seen here")
+
+    async def test_malformed_streamed_clues_are_not_cached(self):
+        key = get_generation_cache_key("generate_regular_clues", {"city": "Atlantis"})
+        clues = [{"location": location, "clue": "Gold"} for location in ["Bank", "Library", "Museum"]]
+
+        async def astream_bare_list(prompt):
+            for text in ['[{"location": "Bank", ', '"clue": "Yen"}]']:
+                yield text
+
+        async def agenerate_clues(prompt, schema):
+            return json.dumps({"clues": clues})
+
+        r = get_redis_connection()
+        r.delete(key)
+
+        try:
+            with unittest.mock.patch.object(carmen_backend, "GENERATION_CACHE_VARIANTS", 3), \
+                 unittest.mock.patch.object(carmen_backend, "astream_generation", astream_bare_list), \
+                 unittest.mock.patch.object(carmen_backend, "agenerate_json", agenerate_clues):
+                streamed = [clue async for clue in carmen_backend._astream_generated_clues(
+                    "generate_regular_clues", {"city": "Atlantis"}, get_regular_clues_prompt("Atlantis")
+                )]
+
+            self.assertEqual(streamed, [{"location": "Bank", "clue": "Yen"}] + clues[1:])
+            self.assertEqual([json.loads(value)["clues"] for value in r.lrange(key, 0, -1)], [clues])
+        finally:
+            r.delete(key)
+
+    async def test_astream_new_game_falls_back_on_malformed_stream(self):
+        game_state = dict(self.GAME_STATE, current_city="Paris", next_hop=1)
+
+        async def astream_malformed(prompt):
+            for text in ['{"case_id": "x", "suspect_name": "Bobo", ', '"current_city": "Paris" "stolen_item": "Mona Lisa"}']:
+                yield text
+
+        async def agenerate_new_game():
+            return json.dumps(game_state)
+
+        with unittest.mock.patch.object(carmen_backend, "apop_pooled_game", unittest.mock.AsyncMock(return_value=None)), \
+             unittest.mock.patch.object(carmen_backend, "astream_generation", astream_malformed), \
+             unittest.mock.patch.object(carmen_backend, "agenerate_new_game", agenerate_new_game), \
+             unittest.mock.patch.object(carmen_backend, "HOP_CONTENT_GENERATION", "lazy"):
+            events = [event async for event in astream_new_game()]
+
+        self.assertEqual(events[:4], [
+            {"suspect_name": "Bobo"},
+            {"suspect_name": game_state["suspect_name"]},
+            {"current_city": "Paris"},
+            {"stolen_item": game_state["stolen_item"]},
+        ])
+        self.assertEqual(get_game_state(events[4]["case_id"])["hops"], game_state["hops"])
+
+    async def test_anew_game(self):
+        res = await anew_game()
+
+        self.assertIn(res["case_id"], get_game_states())
+
+class CarmenRulesTest(unittest.TestCase):
+    GAME_STATE = CarmenBackendTest.GAME_STATE
+
+    def setUp(self):
+        self.game_state = json.loads(json.dumps(self.GAME_STATE))
+
+    def test_next_and_previous_city(self):
+        self.assertEqual(get_next_city(self.game_state), "Tokyo")
+        self.assertEqual(get_previous_city(self.game_state), "Cairo")
+
+    def test_previous_city_when_in_correct_city(self):
+        self.game_state["current_city"] = "Cairo"
+
+        self.assertEqual(get_previous_city(self.game_state), "")
+
+    def test_next_city_after_last_hop(self):
+        self.game_state["next_hop"] = MAX_HOPS + 1
+
+        self.assertEqual(get_next_city(self.game_state), "")
+
+    def test_exclude_list(self):
+        self.assertEqual(
+            get_exclude_list(self.game_state),
+            ["Paris", "Rome", "New York", "Sydney"]
+        )
+
+    def test_repair_destinations(self):
+        args = get_destinations_args(self.game_state)
+
+        # The model dropped the next city and offered the current and an excluded city
+        destinations = repair_destinations(["Cairo", "chennai", "Paris", "London", "London"], **args)
+
+        self.assertEqual(len(destinations), 4)
+        self.assertLessEqual({"Cairo", "Tokyo", "London"}, set(destinations))
+        self.assertEqual(len(set(destinations) - set(self.game_state["hops"] + ["Chennai", "London"])), 1)
+
+        self.assertCountEqual(repair_destinations(["Cairo", "Tokyo", "London", "Rio"], **args), ["Cairo", "Tokyo", "London", "Rio"])
+
+        # The required cities don't always come first
+        orders = {tuple(repair_destinations(["Cairo", "Tokyo", "London", "Rio"], **args)) for _ in range(50)}
+        self.assertGreater(len(orders), 1)
+
+    def test_clue_type(self):
+        self.assertEqual(get_clue_type(self.game_state), "mistaken")
+
+        self.game_state["current_city"] = "Cairo"
+        self.assertEqual(get_clue_type(self.game_state), "regular")
+
+        self.game_state["next_hop"] = MAX_HOPS + 1
+        self.assertEqual(get_clue_type(self.game_state), "arrest")
+
+    def test_travel_update(self):
+        self.assertEqual(
+            get_travel_update(self.game_state, "Bangalore"),
+            {"current_city": "Bangalore"}
+        )
+        self.assertEqual(
+            get_travel_update(self.game_state, "Cairo"),
+            {"current_city": "Cairo", "next_hop": 3}
+        )
+        self.assertEqual(
+            get_travel_update(self.game_state, "Tokyo"),
+            {"current_city": "Tokyo", "next_hop": 4}
+        )
+        self.assertIsNone(get_travel_update(self.game_state, "New York"))
+
+    def test_validate_game_state(self):
+        self.game_state["current_city"] = "Paris"
+        self.game_state["next_hop"] = 1
+        validate_game_state(self.game_state)
+
+        self.game_state["hops"] = self.game_state["hops"][:3]
+        with self.assertRaises(Exception):
+            validate_game_state(self.game_state)
+
+    def test_hop_content_only_in_right_city(self):
+        self.game_state["hop_content"] = {"3": {"clues": [], "destinations": []}}
+
+        self.assertIsNone(get_hop_content(self.game_state))
+
+        self.game_state["current_city"] = "Cairo"
+        self.assertEqual(get_hop_content(self.game_state), {"clues": [], "destinations": []})
+
+    def test_hop_content_for_wrong_city(self):
+        mistaken_clues = [{"location": "Bank", "clue": "No one with the suspect's description was seen here"}]
+        self.game_state["hop_content"] = {
+            "3": {"clues": [], "destinations": ["Tokyo", "Lima", "Chennai", "Oslo"], "decoys": ["Lima", "Chennai", "Oslo", "Dubai"]},
+            "mistaken": {"clues": mistaken_clues}
+        }
+
+        self.assertEqual(get_hop_content(self.game_state), {
+            "clues": mistaken_clues,
+            "destinations": ["Cairo", "Tokyo", "Lima", "Oslo"]
+        })
+
+    def test_build_batched_hop_content(self):
+        game_state = dict(self.game_state, hops=["Atlantis", "El Dorado", "Shangri-La", "Avalon", "Camelot", "Asgard"])
+        clues = [{"location": "Bank", "clue": "Gold"}]
+        content = {
+            "hops": [{"city": city, "clues": clues, "decoys": ["Atlantis", "Lima", "Oslo", "Dubai", "Rome"]} for city in game_state["hops"][1:]],
+            "arrest_clues": [{"location": "Bank", "clue": "Congratulations"}],
+            "mistaken_clues": [{"location": "Bank", "clue": "No one"}]
+        }
+
+        hop_content = build_batched_hop_content(game_state, content)
+
+        self.assertEqual(sorted(hop_content), ["1", "2", "3", "4", "5", "6", "mistaken"])
+        self.assertEqual(hop_content["1"], {"clues": clues, "destinations": ["El Dorado", "Lima", "Oslo", "Dubai"], "decoys": ["Lima", "Oslo", "Dubai", "Rome"]})
+        self.assertEqual(hop_content["6"], {"clues": content["arrest_clues"], "destinations": []})
+        self.assertEqual(hop_content["mistaken"], {"clues": content["mistaken_clues"]})
+
+        content["hops"].reverse()
+        with self.assertRaises(Exception):
+            build_batched_hop_content(game_state, content)
+
+        content["hops"].reverse()
+        del content["hops"][0]["clues"]
+        with self.assertRaises(Exception):
+            build_batched_hop_content(game_state, content)
+
+    def test_batched_hop_content_uses_facts_without_clues(self):
+        game_state = dict(self.game_state, hops=["Paris", "London", "Rome", "Tokyo", "Cairo", "Oslo"])
+        content = {
+            "hops": [{"city": city, "decoys": ["Lima", "Dubai", "Madrid", "Berlin"]} for city in game_state["hops"][1:]],
+            "arrest_clues": [{"location": "Bank", "clue": "Congratulations"}],
+            "mistaken_clues": [{"location": "Bank", "clue": "No one"}]
+        }
+
+        self.assertNotIn("only for the cities", get_game_content_prompt(game_state))
+        self.assertIn("only for the cities in ['Atlantis']", get_game_content_prompt(dict(game_state, hops=["Paris", "Atlantis"])))
+        GameContent.model_validate(content)
+
+        hop_content = build_batched_hop_content(game_state, content)
+        self.assertEqual(len(hop_content["1"]["clues"]), 3)
+        for clue in hop_content["1"]["clues"]:
+            if clue["location"] == "Bank":
+                self.assertEqual(clue["clue"], "The suspect changed their currency to Pounds")
+
+    def test_generation_cache_key_is_normalized(self):
+        self.assertEqual(
+            get_generation_cache_key("generate_destinations", {"city": "New  York ", "exclude_list": ["Paris", "Lima"]}),
+            get_generation_cache_key("generate_destinations", {"exclude_list": ["lima", "paris"], "city": "new york"})
+        )
+        self.assertNotEqual(
+            get_generation_cache_key("generate_regular_clues", {"city": "Paris"}),
+            get_generation_cache_key("generate_destinations", {"city": "Paris"})
+        )
+
+    def test_aretry_retries_until_success(self):
+        attempts = []
+
+        @aretry(stop_max_delay=15000, stop_max_attempt_number=3)
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ValueError("flaky")
+
+            return "done"
+
+        self.assertEqual(asyncio.run(flaky()), "done")
+        self.assertEqual(len(attempts), 3)
+
+    def test_aretry_gives_up(self):
+        @aretry(stop_max_delay=15000, stop_max_attempt_number=2)
+        async def failing():
+            raise ValueError("failing")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(failing())
+
+class CarmenRedisPoolTest(unittest.TestCase):
+    def tearDown(self):
+        close_redis_connections()
+
+    def test_connections_share_a_pool(self):
+        self.assertIs(
+            get_redis_connection().connection_pool,
+            get_redis_connection().connection_pool
+        )
+
+    def test_pool_is_recreated_after_close(self):
+        pool = get_redis_pool()
+        close_redis_connections()
+
+        self.assertIsNot(get_redis_pool(), pool)
+
+    def test_pool_from_url(self):
+        with unittest.mock.patch.object(carmen_backend, "REDIS_URL", "redis://:secret@redis.internal:7000/3"):
+            kwargs = get_redis_pool().connection_kwargs
+
+        self.assertEqual((kwargs["host"], kwargs["port"], kwargs["db"], kwargs["password"]), ("redis.internal", 7000, 3, "secret"))
+
+    def test_sentinel_pool(self):
+        import redis.sentinel
+
+        with unittest.mock.patch.object(carmen_backend, "REDIS_MODE", "sentinel"), \
+             unittest.mock.patch.object(carmen_backend, "REDIS_NODES", "sentinel-1:26379, sentinel-2:26379"), \
+             unittest.mock.patch.object(carmen_backend, "REDIS_DB", "4"):
+            pool = get_redis_pool()
+
+            self.assertIsInstance(pool, redis.sentinel.SentinelConnectionPool)
+            self.assertEqual(pool.service_name, REDIS_SENTINEL_SERVICE)
+            self.assertEqual(pool.connection_kwargs["db"], 4)
+            self.assertEqual(get_redis_nodes(), [("sentinel-1", 26379), ("sentinel-2", 26379)])
+
+    def test_nodes_are_required(self):
+        with unittest.mock.patch.object(carmen_backend, "REDIS_MODE", "cluster"), \
+             unittest.mock.patch.object(carmen_backend, "REDIS_NODES", ""):
+            with self.assertRaises(Exception):
+                get_redis_connection()
+
+class CarmenClientCacheTest(unittest.TestCase):
+    def test_llm_clients_are_cached(self):
+        self.assertIs(get_llm("openai", "generation"), get_llm("openai", "generation"))
+        self.assertIsNot(get_llm("openai", "generation"), get_llm("openai", "agent"))
+
+    def test_llm_uses_requested_provider(self):
+        self.assertEqual(get_llm("openai", "agent").model_name, models["openai"]["agent"])
+
+    def test_agent_executor_is_cached(self):
+        self.assertIs(get_agent_executor(), get_agent_executor())
+
+class CarmenCityFactsTest(unittest.TestCase):
+    def test_all_famous_cities_have_facts(self):
+        for city in famous_cities:
+            facts = get_city_facts(city)
+
+            self.assertIsNotNone(facts, city)
+            validate_city_facts(facts)
+
+    def test_city_facts_path_does_not_depend_on_working_directory(self):
+        self.assertTrue(os.path.isabs(CITY_FACTS_PATH))
+        self.assertTrue(os.path.exists(CITY_FACTS_PATH))
+
+    def test_city_facts_lookup_is_case_insensitive(self):
+        self.assertEqual(get_city_facts(" paris"), get_city_facts("Paris"))
+        self.assertIsNone(get_city_facts("Bangalore"))
+
+    def test_generate_clues_from_facts(self):
+        clues = json.loads(generate_clues_from_facts(get_city_facts("London")))["clues"]
+
+        self.assertEqual(len(clues), 3)
+        self.assertEqual(len({clue["location"] for clue in clues}), 3)
+        for clue in clues:
+            self.assertIn(clue["location"], clue_locations)
+            self.assertIsInstance(clue["clue"], str)
+
+    def test_regular_clues_for_known_city_use_facts(self):
+        clues = json.loads(generate_regular_clues.invoke({"city": "London"}))["clues"]
+        bank_clues = [clue["clue"] for clue in clues if clue["location"] == "Bank"]
+
+        for clue in bank_clues:
+            self.assertEqual(clue, "The suspect changed their currency to Pounds")
+
+class CarmenJsonStreamParserTest(unittest.TestCase):
+    def feed_in_chunks(self, text, size):
+        parser = JsonStreamParser()
+        events = []
+        for i in range(0, len(text), size):
+            events.extend(parser.feed(text[i:i + size]))
+
+        return events
+
+    def test_array_items_are_emitted_as_they_complete(self):
+        text = '```json\n{"clues": [{"location": "Bank", "clue": "Pounds, [not] {json}"}, {"location": "Library", "clue": "Dickens"}]}\n```'
+
+        items = [value for kind, value in self.feed_in_chunks(text, 3) if kind == "item"]
+
+        self.assertEqual(items, [
+            {"location": "Bank", "clue": "Pounds, [not] {json}"},
+            {"location": "Library", "clue": "Dickens"}
+        ])
+
+    def test_top_level_members_are_emitted_as_they_complete(self):
+        text = 'Here you go: {"suspect_name": "Bobo \\"the\\" Clown", "hops": ["Paris", "Rome"], "next_hop": 1}'
+
+        members = [value for kind, value in self.feed_in_chunks(text, 1) if kind == "member"]
+
+        self.assertEqual(members, [
+            ("suspect_name", 'Bobo "the" Clown'),
+            ("hops", ["Paris", "Rome"]),
+            ("next_hop", 1)
+        ])
+
+    def test_items_without_enclosing_object(self):
+        events = JsonStreamParser().feed('"clues": [{"location": "Bank", "clue": "Yen"}]')
+
+        self.assertEqual(events, [("item", {"location": "Bank", "clue": "Yen"})])
+
+    def test_malformed_values_are_skipped(self):
+        parser = JsonStreamParser()
+        events = parser.feed('{"suspect_name": "Bobo", "hops": ["Paris" "Rome"], "next_hop": 1}')
+
+        self.assertEqual(events, [("member", ("suspect_name", "Bobo")), ("member", ("next_hop", 1))])
+        self.assertTrue(parser.malformed)
+
+class CarmenStructuredOutputTest(unittest.TestCase):
+    def test_parse_json_output_repairs_formatting(self):
+        expected = {"city": "Paris", "destinations": ["Rome", "Lima"]}
+
+        for text in [
+            '{"city": "Paris", "destinations": ["Rome", "Lima"]}',
+            '```json\n{"city": "Paris", "destinations": ["Rome", "Lima"]}\n```',
+            'Here are the destinations: {"city": "Paris", "destinations": ["Rome", "Lima"]} Have fun!',
+            '{"city": "Paris", "destinations": ["Rome", "Lima",],}',
+            "{'city': 'Paris', 'destinations': ['Rome', 'Lima']}",
+            '"city": "Paris", "destinations": ["Rome", "Lima"]'
+        ]:
+            self.assertEqual(parse_json_output(text), expected, text)
+
+    def test_parse_json_output_joins_content_blocks(self):
+        output = [{"type": "text", "text": '{"current_city": '}, {"type": "text", "text": '"Rome"}'}]
+
+        self.assertEqual(parse_json_output(output), {"current_city": "Rome"})
+
+    def test_parse_json_output_rejects_prose(self):
+        with self.assertRaises(ValueError):
+            parse_json_output("You cannot travel to that city")
+
+    def test_parse_structured_output_validates_schema(self):
+        clues = parse_structured_output('{"clues": [{"location": "Bank", "clue": "Yen"}]}', Clues)
+        self.assertEqual(clues.clues[0].location, "Bank")
+
+        for text in ['{"clues": []}', '{"clues": [{"location": "Bank"}]}', '{"destinations": "Rome"}']:
+            with self.assertRaises(ValueError):
+                parse_structured_output(text, Clues if "clues" in text else Destinations)
+
+    def test_native_output_falls_back_only_on_structured_output_errors(self):
+        llm = unittest.mock.Mock()
+        llm.invoke.return_value = unittest.mock.Mock(content='{"clues": [{"location": "Bank", "clue": "Yen"}]}')
+
+        with unittest.mock.patch.object(carmen_backend, "get_generation_llm", lambda: llm), \
+             unittest.mock.patch.object(carmen_backend, "STRUCTURED_OUTPUT", "native"):
+            llm.with_structured_output.return_value.invoke.side_effect = ProviderError(429)
+            with self.assertRaises(ProviderError):
+                generate_json("prompt", Clues)
+            llm.invoke.assert_not_called()
+
+            for error in [ValueError("bad reply"), NotImplementedError(), ProviderError(400)]:
+                llm.with_structured_output.return_value.invoke.side_effect = error
+                self.assertEqual(json.loads(generate_json("prompt", Clues))["clues"][0]["clue"], "Yen")
+
+            llm.with_structured_output.return_value.invoke.side_effect = None
+            llm.with_structured_output.return_value.invoke.return_value = None
+            self.assertEqual(json.loads(generate_json("prompt", Clues))["clues"][0]["clue"], "Yen")
+
+    def test_parse_agent_output_drops_missing_fields(self):
+        self.assertEqual(parse_agent_output('{"error": "You cannot travel to that city"}', TravelResult),
+                         {"error": "You cannot travel to that city"})
+
+class CarmenToolCacheTest(unittest.TestCase):
+    def test_tool_cache_counts_hits(self):
+        cache = ToolCache()
+        calls = []
+
+        for _ in range(3):
+            value = cache.get("fetch_game_state", "a", lambda: calls.append("a") or "state")
+
+        self.assertEqual(value, "state")
+        self.assertEqual(calls, ["a"])
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 1})
+
+    def test_tool_cache_invalidate(self):
+        cache = ToolCache()
+        cache.get("fetch_game_state", "a", lambda: "state")
+        cache.get("python_repl", "print(1)", lambda: "1")
+
+        cache.invalidate("python_repl")
+        self.assertEqual(list(cache.values), [("fetch_game_state", "a")])
+
+        cache.invalidate()
+        self.assertEqual(cache.values, {})
+
+    def test_results_computed_across_an_invalidation_are_not_cached(self):
+        cache = ToolCache()
+
+        def fetch_racing_a_write():
+            cache.invalidate()
+            return "old state"
+
+        self.assertEqual(cache.get("fetch_game_state", "a", fetch_racing_a_write), "old state")
+        self.assertEqual(cache.get("fetch_game_state", "a", lambda: "new state"), "new state")
+
+        cache.add_game_state("a", {"next_hop": 1}, cache.generation - 1)
+        self.assertEqual(cache.get_game_states(), {})
+
+    def test_tool_calls_outside_an_agent_run_are_not_cached(self):
+        calls = []
+
+        cached_tool_call("fetch_game_state", "a", lambda: calls.append("a"))
+        cached_tool_call("fetch_game_state", "a", lambda: calls.append("a"))
+
+        self.assertEqual(len(calls), 2)
+
+class CarmenMetricsTest(unittest.TestCase):
+    def setUp(self):
+        metrics.clear()
+
+    def test_render_counters_and_histograms(self):
+        metrics.inc("carmen_test_total", 2, provider="openai")
+        metrics.observe("carmen_test_seconds", 0.2, kind="redis")
+
+        text = metrics.render()
+
+        self.assertIn('carmen_test_total{provider="openai"} 2', text)
+        self.assertIn('carmen_test_seconds_bucket{kind="redis",le="0.1"} 0', text)
+        self.assertIn('carmen_test_seconds_bucket{kind="redis",le="0.25"} 1', text)
+        self.assertIn('carmen_test_seconds_bucket{kind="redis",le="+Inf"} 1', text)
+        self.assertIn('carmen_test_seconds_count{kind="redis"} 1', text)
+
+    def test_span_records_errors_and_request_spans(self):
+        spans = start_request_spans()
+
+        with self.assertRaises(ValueError):
+            with span("tool", "fetch_game_state"):
+                raise ValueError("boom")
+
+        self.assertEqual([(kind, name) for kind, name, _ in spans], [("tool", "fetch_game_state")])
+        self.assertIn('carmen_span_seconds_count{kind="tool",name="fetch_game_state",status="error"} 1', metrics.render())
+
+    def test_retry_records_each_attempt(self):
+        attempts = []
+
+        @retry(stop_max_delay=1000, stop_max_attempt_number=3)
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise Exception("flaky")
+
+            return "ok"
+
+        self.assertEqual(flaky(), "ok")
+
+        text = metrics.render()
+        self.assertIn('carmen_span_seconds_count{kind="attempt",name="flaky",status="error"} 2', text)
+        self.assertIn('carmen_span_seconds_count{kind="attempt",name="flaky",status="ok"} 1', text)
+
+    def test_http_requests_are_labelled_by_route(self):
+        from fastapi.testclient import TestClient
+        import server
+
+        client = TestClient(server.app)
+        client.get("/metrics")
+        client.get("/probe-1")
+        client.get("/probe-2")
+
+        text = metrics.render()
+        self.assertIn('path="/metrics"', text)
+        self.assertIn('path="unmatched"', text)
+        self.assertNotIn("probe", text)
+
+    def test_format_server_timing(self):
+        spans = [("redis", "GET", 0.002), ("llm", "openai:gpt-4", 1.5), ("redis", "SET", 0.001)]
+
+        self.assertEqual(format_server_timing(spans, 1.6),
+                         'redis;dur=3.0;desc="2 calls", llm;dur=1500.0;desc="1 calls", total;dur=1600.0')
+
+    def test_llm_tokens_and_cost(self):
+        from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+        from langchain_core.messages import AIMessage
+
+        usage = {"input_tokens": 1000, "output_tokens": 500, "total_tokens": 1500}
+        llm = GenericFakeChatModel(messages=iter([AIMessage(content="{}", usage_metadata=usage)]),
+                                   callbacks=[LLMMetricsHandler("anthropic", "claude-3-opus-20240229")])
+        llm.invoke("hi")
+
+        labels = {"provider": "anthropic", "model": "claude-3-opus-20240229"}
+        self.assertEqual(metrics.get("carmen_llm_tokens_total", type="input", **labels), 1000)
+        self.assertEqual(metrics.get("carmen_llm_tokens_total", type="output", **labels), 500)
+        self.assertAlmostEqual(metrics.get("carmen_llm_cost_usd_total", **labels), 0.0525)
+
+class ProviderError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+class FakeProvider:
+    def __init__(self, name, delay=0, error=None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def invoke(self, prompt):
+        self.calls += 1
+        if self.error:
+            raise self.error
+
+        return self.name
+
+    async def ainvoke(self, prompt):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+
+        return self.name
+
+class CarmenRouterTest(unittest.TestCase):
+    providers = ["openai", "anthropic", "groq"]
+
+    def setUp(self):
+        router.clear()
+
+    def test_is_failover_error(self):
+        self.assertTrue(is_failover_error(ProviderError(429)))
+        self.assertTrue(is_failover_error(ProviderError(503)))
+        self.assertTrue(is_failover_error(TimeoutError()))
+        self.assertFalse(is_failover_error(ProviderError(400)))
+        self.assertFalse(is_failover_error(ValueError()))
+
+    def test_rank_by_latency_then_errors_then_cooldown(self):
+        router.record("openai", "generation", 2.0)
+        router.record("anthropic", "generation", 1.0)
+        router.record("groq", "generation", 0.5)
+        self.assertEqual(router.rank("generation", self.providers), ["groq", "anthropic", "openai"])
+
+        router.record_failure("groq", "generation", ProviderError(429))
+        self.assertEqual(router.rank("generation", self.providers), ["anthropic", "openai", "groq"])
+
+        for _ in range(3):
+            router.record("anthropic", "generation", ok=False)
+        self.assertEqual(router.rank("generation", self.providers), ["openai", "anthropic", "groq"])
+
+    def test_unmeasured_providers_rank_after_measured_healthy_ones(self):
+        self.assertEqual(router.rank("generation", self.providers), ["openai", "anthropic", "groq"])
+
+        router.record("openai", "generation", 0.4)
+        self.assertEqual(router.rank("generation", self.providers), ["openai", "anthropic", "groq"])
+
+        router.record_failure("openai", "generation", ProviderError(503))
+        self.assertEqual(router.rank("generation", self.providers), ["anthropic", "groq", "openai"])
+
+    def test_router_providers_default_to_model_provider(self):
+        with unittest.mock.patch.object(carmen_backend, "ROUTER_PROVIDERS", []), \
+             unittest.mock.patch.object(carmen_backend, "ANTHROPIC_API_KEY", "key"), \
+             unittest.mock.patch.object(carmen_backend, "GROQ_API_KEY", "key"):
+            self.assertEqual(get_router_providers(), [model_provider])
+
+    def test_bad_requests_do_not_affect_health(self):
+        router.record_failure("openai", "generation", ProviderError(400))
+
+        self.assertEqual(router.error_rate("openai", "generation"), 0.0)
+        self.assertEqual(router.rank("generation", self.providers)[0], "openai")
+
+    def test_latency_quantiles(self):
+        for latency in range(1, 101):
+            router.record("openai", "generation", latency / 100)
+
+        self.assertAlmostEqual(router.latency("openai", "generation"), 0.505)
+        self.assertAlmostEqual(router.latency("openai", "generation", 0.95), 0.9505)
+        self.assertIsNone(router.latency("groq", "generation"))
+
+    def test_fails_over_on_rate_limit(self):
+        fakes = {name: FakeProvider(name) for name in self.providers}
+        fakes["openai"].error = ProviderError(429)
+
+        with unittest.mock.patch.object(carmen_backend, "get_llm", lambda provider, purpose: fakes[provider]), \
+             unittest.mock.patch.object(carmen_backend, "ROUTER_PROVIDERS", self.providers):
+            self.assertEqual(get_generation_llm().invoke("prompt"), "anthropic")
+            get_generation_llm().invoke("prompt")
+
+            fakes["openai"].error = ProviderError(400)
+            router.clear()
+            with self.assertRaises(ProviderError):
+                get_generation_llm().invoke("prompt")
+
+        self.assertEqual(fakes["openai"].calls, 2)
+
+    def test_hedges_slow_provider(self):
+        fakes = {"openai": FakeProvider("openai", delay=5), "anthropic": FakeProvider("anthropic", delay=0.01)}
+
+        with unittest.mock.patch.object(carmen_backend, "get_llm", lambda provider, purpose: fakes[provider]), \
+             unittest.mock.patch.object(carmen_backend, "ROUTER_PROVIDERS", ["openai", "anthropic"]), \
+             unittest.mock.patch.object(carmen_backend, "ROUTER_HEDGE", True), \
+             unittest.mock.patch.object(carmen_backend, "ROUTER_HEDGE_DELAY", 0.05):
+            self.assertEqual(asyncio.run(get_generation_llm().ainvoke("prompt")), "anthropic")
+
+        # Only the hedge that answered is measured, the cancelled call doesn't count as a fast success
+        self.assertIsNone(router.latency("openai", "generation"))
+        self.assertIsNotNone(router.latency("anthropic", "generation"))
+
+    def test_cancelled_call_keeps_backoff(self):
+        fakes = {"openai": FakeProvider("openai", delay=5)}
+        router.record_failure("openai", "generation", ProviderError(503))
+
+        async def cancel_call():
+            task = asyncio.ensure_future(get_generation_llm()._acall("openai", "prompt"))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with unittest.mock.patch.object(carmen_backend, "get_llm", lambda provider, purpose: fakes[provider]):
+            asyncio.run(cancel_call())
+
+        self.assertEqual(router.failures[("openai", "generation")], 1)
+        self.assertEqual(router.error_rate("openai", "generation"), 1.0)
+
+class CarmenParallelAgentExecutorTest(unittest.TestCase):
+    def test_tool_calls_from_one_turn_run_concurrently_in_order(self):
+        import time
+        from langchain_core.agents import AgentAction, AgentFinish
+        from langchain_core.runnables import RunnableLambda
+        from langchain_core.tools import tool
+
+        @tool
+        def slow_tool(value: int) -> str:
+            """ Sleeps before returning the value """
+            time.sleep(0.2)
+            return str(value)
+
+        def plan(inputs):
+            if inputs["intermediate_steps"]:
+                return AgentFinish({"output": [step[1] for step in inputs["intermediate_steps"]]}, "")
+
+            return [AgentAction("slow_tool", {"value": value}, "") for value in range(4)]
+
+        executor = ParallelAgentExecutor(agent=RunnableLambda(plan), tools=[slow_tool])
+
+        start = time.monotonic()
+        output = executor.invoke({"input": "go"})["output"]
+
+        self.assertEqual(output, ["0", "1", "2", "3"])
+        self.assertLess(time.monotonic() - start, 0.6)
+
+    def test_game_state_writes_are_barriers(self):
+        import time
+        import threading
+        from langchain_core.agents import AgentAction, AgentFinish
+        from langchain_core.runnables import RunnableLambda
+        from langchain_core.tools import tool
+
+        events = []
+        lock = threading.Lock()
+
+        def record(name, delay):
+            with lock:
+                events.append(f"start {name}")
+            time.sleep(delay)
+            with lock:
+                events.append(f"end {name}")
+            return name
+
+        @tool
+        def read_state(name: str) -> str:
+            """ Records a read """
+            return record(name, 0.1)
+
+        @tool
+        def update_game_state(name: str) -> str:
+            """ Records a write """
+            return record(name, 0.01)
+
+        def plan(inputs):
+            if inputs["intermediate_steps"]:
+                return AgentFinish({"output": [step[1] for step in inputs["intermediate_steps"]]}, "")
+
+            return [
+                AgentAction("read_state", {"name": "before"}, ""),
+                AgentAction("update_game_state", {"name": "write"}, ""),
+                AgentAction("read_state", {"name": "after"}, ""),
+            ]
+
+        executor = ParallelAgentExecutor(agent=RunnableLambda(plan), tools=[read_state, update_game_state])
+
+        async def ainvoke():
+            carmen_backend._tool_barrier.set(ToolBarrier())
+            return await executor.ainvoke({"input": "go"})
+
+        for invoke in [lambda: executor.invoke({"input": "go"}), lambda: asyncio.run(ainvoke())]:
+            events.clear()
+
+            self.assertEqual(invoke()["output"], ["before", "write", "after"])
+            self.assertEqual(events, ["start before", "end before", "start write", "end write", "start after", "end after"])
+
+class CarmenPythonSandboxTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        import socket
+
+        # An open socket in the server that a forked worker would have inherited
+        cls.server_socket = socket.socket()
+        cls.sandbox = PythonSandbox(workers=1, timeout=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sandbox.close()
+        cls.server_socket.close()
+
+    def test_runs_with_helpers_and_variables(self):
+        game_state = {"hops": ["Paris", "Tokyo"], "next_hop": 1}
+        output = self.sandbox.run("print(get_next_city(game_states['case']), MAX_HOPS)", {"game_states": {"case": game_state}})
+
+        self.assertEqual(output, f"Tokyo {MAX_HOPS}\n")
+
+    def test_fresh_namespace_per_run(self):
+        self.sandbox.run("leaked = 1")
+
+        self.assertIn("NameError", self.sandbox.run("print(leaked)"))
+
+    def test_network_is_blocked(self):
+        self.assertIn("PermissionError", self.sandbox.run("import socket; socket.create_connection(('127.0.0.1', 80))"))
+        self.assertIn("PermissionError", self.sandbox.run("import _socket; _socket.socket()"))
+
+    def test_processes_are_blocked(self):
+        self.assertIn("PermissionError", self.sandbox.run("import subprocess; subprocess.run(['python', '-c', '1'])"))
+        self.assertIn("PermissionError", self.sandbox.run("import os; os.kill(os.getppid(), 0)"))
+
+    def test_server_secrets_are_not_reachable(self):
+        with unittest.mock.patch.dict(os.environ, {"OPENAI_API_KEY": "sandbox-test-key"}):
+            sandbox = PythonSandbox(workers=1, timeout=1)
+
+        try:
+            self.assertEqual(sandbox.run("import os; print(os.environ.get('OPENAI_API_KEY'))"), "None\n")
+            self.assertEqual(sandbox.run("import sys; print('carmen_backend' in sys.modules)"), "False\n")
+            self.assertIn("Error", sandbox.run("import carmen_backend"))
+            self.assertNotIn("sandbox-test-key", sandbox.run("import os; print(open(f'/proc/{os.getppid()}/environ').read())"))
+        finally:
+            sandbox.close()
+
+    def test_server_file_descriptors_are_not_inherited(self):
+        code = "\n".join([
+            "import os, stat",
+            "sockets = []",
+            "for fd in range(256):",
+            "    try:",
+            "        if stat.S_ISSOCK(os.fstat(fd).st_mode): sockets.append(fd)",
+            "    except OSError: pass",
+            "print(sockets)",
+        ])
+
+        self.assertEqual(self.sandbox.run(code), "[]\n")
+
+    def test_exit_does_not_end_worker(self):
+        self.assertIn("SystemExit", self.sandbox.run("import sys; sys.exit(1)"))
+        self.assertEqual(self.sandbox.run("print('ok')"), "ok\n")
+
+    def test_timeout_replaces_worker(self):
+        self.assertIn("TimeoutError", self.sandbox.run("while True: pass"))
+        self.assertEqual(self.sandbox.run("print('ok')"), "ok\n")
+
+    def test_failed_replacement_keeps_slot(self):
+        sandbox = PythonSandbox(workers=1, timeout=1)
+
+        try:
+            with unittest.mock.patch.object(sandbox, "_start_worker", side_effect=Exception("no worker")):
+                self.assertIn("TimeoutError", sandbox.run("while True: pass"))
+                with self.assertRaises(ToolException):
+                    sandbox.run("print('ok')")
+
+            self.assertEqual(sandbox.run("print('ok')"), "ok\n")
+        finally:
+            sandbox.close()
+
+    def test_waiting_for_worker_times_out(self):
+        sandbox = PythonSandbox(workers=1, timeout=1)
+        sandbox.wait_timeout = 0.1
+        worker = sandbox.idle.get()
+
+        try:
+            with self.assertRaises(ToolException):
+                sandbox.run("print('ok')")
+        finally:
+            sandbox.idle.put(worker)
+            sandbox.close()
+
+class CarmenGameStorageTest(unittest.TestCase):
+    def test_compact_encoding_round_trip(self):
+        game_state = {
+            "case_id": "case",
+            "current_city": "Paris",
+            "hops": ["Paris", "Tokyo", "Atlantis"],
+            "next_hop": 1,
+            "hop_content": {"1": {"clues": [], "destinations": ["Tokyo", "Atlantis"], "decoys": ["Rome"]}},
+        }
+
+        compact = compact_game_state_fields(game_state)
+        self.assertEqual(compact["current_city"], famous_cities.index("Paris"))
+        self.assertEqual(compact["hops"][2], "Atlantis")
+        self.assertEqual(compact["hop_content"]["1"]["decoys"], [famous_cities.index("Rome")])
+
+        self.assertEqual(load_game_state(dump_game_state(game_state)), game_state)
+        self.assertEqual(load_game_state(json.dumps(game_state)), game_state)
+
+    def test_archive_round_trip(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "archive.jsonl.gz")
+            archive_game_state({"case_id": "first"}, path)
+            archive_game_state({"case_id": "second"}, path)
+
+            self.assertEqual([game["case_id"] for game in iter_archived_game_states(path)], ["first", "second"])
+
+    def test_finishing_update(self):
+        self.assertTrue(is_finishing_update({"next_hop": MAX_HOPS + 1}))
+        self.assertTrue(is_finishing_update({"next_hop": str(MAX_HOPS + 1)}))
+        self.assertFalse(is_finishing_update({"next_hop": MAX_HOPS}))
+        self.assertFalse(is_finishing_update({"current_city": "Paris"}))
+
+@unittest.skipUnless(importlib.util.find_spec("fakeredis"), "The benchmark needs fakeredis")
+class CarmenBenchmarkTest(unittest.TestCase):
+    def test_players_finish_games(self):
+        import benchmark
+
+        with unittest.mock.patch.object(carmen_backend, "get_llm", carmen_backend.get_llm), \
+             unittest.mock.patch.object(carmen_backend, "get_redis_connection", carmen_backend.get_redis_connection), \
+             unittest.mock.patch.object(carmen_backend, "get_async_redis_connection", carmen_backend.get_async_redis_connection), \
+             unittest.mock.patch.object(carmen_backend, "STRUCTURED_OUTPUT", "json"), \
+             unittest.mock.patch.object(carmen_backend, "GAME_POOL_DEPTH", 0), \
+             unittest.mock.patch.object(carmen_backend, "GAME_ARCHIVE_PATH", ""):
+            report = asyncio.run(benchmark.run_benchmark(players=2, games=1, latency=0, tokens_per_second=0, malformed_rate=0))
+
+        self.assertEqual(report["games_finished"], 2)
+        self.assertEqual(report["errors"], {})
+        self.assertEqual(report["llm_calls"]["new_game"], 2)
+        self.assertEqual(report["endpoints"]["/new_game"]["count"], 2)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,251 @@
+""" Worker process for the python sandbox of carmen_backend.PythonSandbox
+
+The worker is started as a fresh interpreter (python -I -S python_sandbox.py) with an empty environment and no file
+descriptors besides its pipes, so nothing of the server (api keys, redis connections, imported modules) is reachable
+from it. It only imports the standard library and must never import carmen_backend.
+
+Before running any snippet the worker locks itself down:
+
+- rlimits on memory, file size and process count (RLIMIT_NPROC is not enforced for root, seccomp covers that)
+- landlock, when the kernel supports it, so only the python standard library can be read
+- a seccomp filter that fails process creation, exec, sockets, signals to other processes and namespace changes
+  with EPERM
+
+Messages are json lines. The first one from the server holds the prelude source and the limits, the worker answers
+{"ready": ...} or {"error": ...}. Each request after that is {"id", "code", "variables"} and is answered with
+{"id", "output"}.
+"""
+import os
+import io
+import sys
+import json
+import ctypes
+import struct
+import resource
+import platform
+import contextlib
+
+PR_SET_NO_NEW_PRIVS = 38
+PR_SET_SECCOMP = 22
+SECCOMP_MODE_FILTER = 2
+
+SECCOMP_RET_ALLOW = 0x7fff0000
+SECCOMP_RET_ERRNO = 0x00050000
+
+# Classic bpf opcodes used by the filter
+BPF_LD_W_ABS = 0x20
+BPF_JEQ_K = 0x15
+BPF_JGE_K = 0x35
+BPF_RET_K = 0x06
+
+# Offsets into struct seccomp_data
+SECCOMP_DATA_NR = 0
+SECCOMP_DATA_ARCH = 4
+
+# Syscalls that fail with EPERM in the sandbox, clone3 fails with ENOSYS so libc falls back to clone
+blocked_syscalls = {
+    "x86_64": {
+        "audit_arch": 0xc000003e,
+        # The x32 abi sets this bit on every syscall number
+        "x32_bit": 0x40000000,
+        "syscalls": {
+            "socket": 41, "connect": 42, "accept": 43, "bind": 49, "listen": 50, "socketpair": 53, "accept4": 288,
+            "clone": 56, "fork": 57, "vfork": 58, "execve": 59, "execveat": 322,
+            "kill": 62, "tkill": 200, "tgkill": 234, "pidfd_send_signal": 424,
+            "ptrace": 101, "process_vm_readv": 310, "process_vm_writev": 311,
+            "unshare": 272, "setns": 308, "mount": 165, "umount2": 166, "pivot_root": 155, "chroot": 161,
+            "io_uring_setup": 425, "bpf": 321, "perf_event_open": 298, "keyctl": 250,
+        },
+    },
+    "aarch64": {
+        "audit_arch": 0xc00000b7,
+        "x32_bit": None,
+        "syscalls": {
+            "socket": 198, "connect": 203, "accept": 202, "bind": 200, "listen": 201, "socketpair": 199, "accept4": 242,
+            "clone": 220, "execve": 221, "execveat": 281,
+            "kill": 129, "tkill": 130, "tgkill": 131, "pidfd_send_signal": 424,
+            "ptrace": 117, "process_vm_readv": 270, "process_vm_writev": 271,
+            "unshare": 97, "setns": 268, "mount": 40, "umount2": 39, "pivot_root": 41, "chroot": 51,
+            "io_uring_setup": 425, "bpf": 280, "perf_event_open": 241, "keyctl": 219,
+        },
+    },
+}
+CLONE3 = 435
+
+# Landlock syscalls have the same numbers on every architecture
+SYS_LANDLOCK_CREATE_RULESET = 444
+SYS_LANDLOCK_ADD_RULE = 445
+SYS_LANDLOCK_RESTRICT_SELF = 446
+LANDLOCK_CREATE_RULESET_VERSION = 1
+LANDLOCK_RULE_PATH_BENEATH = 1
+LANDLOCK_ACCESS_FS_READ_FILE = 1 << 2
+LANDLOCK_ACCESS_FS_READ_DIR = 1 << 3
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.syscall.restype = ctypes.c_long
+
+def _call(function, name: str, *args) -> int:
+    # syscall and prctl are variadic and read every argument as a long
+    result = function(*[ctypes.c_long(arg) if isinstance(arg, int) else arg for arg in args])
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"{name} failed: {os.strerror(errno)}")
+
+    return result
+
+def get_seccomp_filter(machine: str) -> bytes:
+    """ Returns the bpf program of the seccomp filter for machine as packed struct sock_filter entries """
+    if machine not in blocked_syscalls:
+        raise Exception(f"The python sandbox has no seccomp filter for {machine}")
+
+    arch = blocked_syscalls[machine]
+    deny = SECCOMP_RET_ERRNO | 1
+
+    program = [
+        (BPF_LD_W_ABS, 0, 0, SECCOMP_DATA_ARCH),
+        # Syscalls made through another abi (e.g. int 0x80 on x86_64) are all denied
+        (BPF_JEQ_K, 1, 0, arch["audit_arch"]),
+        (BPF_RET_K, 0, 0, deny),
+        (BPF_LD_W_ABS, 0, 0, SECCOMP_DATA_NR),
+    ]
+
+    if arch["x32_bit"] is not None:
+        program += [(BPF_JGE_K, 0, 1, arch["x32_bit"]), (BPF_RET_K, 0, 0, deny)]
+
+    program += [(BPF_JEQ_K, 0, 1, CLONE3), (BPF_RET_K, 0, 0, SECCOMP_RET_ERRNO | 38)]
+
+    for number in arch["syscalls"].values():
+        program += [(BPF_JEQ_K, 0, 1, number), (BPF_RET_K, 0, 0, deny)]
+
+    program.append((BPF_RET_K, 0, 0, SECCOMP_RET_ALLOW))
+
+    return b"".join(struct.pack("HBBI", *instruction) for instruction in program)
+
+def install_seccomp_filter():
+    program = get_seccomp_filter(platform.machine())
+    buffer = ctypes.create_string_buffer(program, len(program))
+
+    class SockFprog(ctypes.Structure):
+        _fields_ = [("len", ctypes.c_ushort), ("filter", ctypes.c_void_p)]
+
+    fprog = SockFprog(len(program) // 8, ctypes.addressof(buffer))
+
+    _call(_libc.prctl, "prctl(PR_SET_NO_NEW_PRIVS)", PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)
+    _call(_libc.prctl, "prctl(PR_SET_SECCOMP)", PR_SET_SECCOMP, SECCOMP_MODE_FILTER, ctypes.pointer(fprog), 0, 0)
+
+def get_landlock_abi() -> int:
+    """ Returns the landlock abi version of the kernel or 0 if landlock is not available """
+    try:
+        return _call(_libc.syscall, "landlock_create_ruleset", SYS_LANDLOCK_CREATE_RULESET, None, 0,
+                     LANDLOCK_CREATE_RULESET_VERSION)
+    except OSError:
+        return 0
+
+def restrict_filesystem(readable: list) -> bool:
+    """ Denies all filesystem access except reading below the readable paths, returns False without landlock """
+    abi = get_landlock_abi()
+    if abi < 1:
+        return False
+
+    # Every access right the kernel knows about is handled, so anything not granted below is denied
+    handled = (1 << 13) - 1
+    if abi >= 2:
+        handled |= 1 << 13
+    if abi >= 3:
+        handled |= 1 << 14
+    if abi >= 5:
+        handled |= 1 << 15
+
+    ruleset_attr = struct.pack("Q", handled)
+    ruleset = _call(_libc.syscall, "landlock_create_ruleset", SYS_LANDLOCK_CREATE_RULESET, ruleset_attr,
+                    len(ruleset_attr), 0)
+
+    try:
+        for path in readable:
+            if not os.path.exists(path):
+                continue
+
+            access = LANDLOCK_ACCESS_FS_READ_FILE
+            if os.path.isdir(path):
+                access |= LANDLOCK_ACCESS_FS_READ_DIR
+
+            fd = os.open(path, os.O_PATH | os.O_CLOEXEC)
+            try:
+                rule = struct.pack("=Qi", access, fd)
+                _call(_libc.syscall, "landlock_add_rule", SYS_LANDLOCK_ADD_RULE, ruleset, LANDLOCK_RULE_PATH_BENEATH,
+                      rule, 0)
+            finally:
+                os.close(fd)
+
+        _call(_libc.prctl, "prctl(PR_SET_NO_NEW_PRIVS)", PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)
+        _call(_libc.syscall, "landlock_restrict_self", SYS_LANDLOCK_RESTRICT_SELF, ruleset, 0)
+    finally:
+        os.close(ruleset)
+
+    return True
+
+def limit_worker(memory_mb: int) -> dict:
+    """ Locks the worker down, returns which of the optional protections could be applied """
+    if sys.platform != "linux":
+        raise Exception("The python sandbox needs linux, use PYTHON_EXECUTION=inprocess elsewhere")
+
+    with open("/proc/self/statm") as f:
+        size = int(f.read().split()[0]) * resource.getpagesize()
+    memory = size + memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_NPROC, (0, 0))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+    # Only the standard library can be imported after this
+    landlock = restrict_filesystem([path for path in sys.path if path])
+    install_seccomp_filter()
+
+    return {"landlock": landlock}
+
+def main():
+    # The protocol gets its own descriptors so that snippets writing to fd 0 or 1 can't corrupt it
+    os.closerange(3, os.sysconf("SC_OPEN_MAX"))
+    requests = os.fdopen(os.dup(0), "r")
+    responses = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in [0, 1, 2]:
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+    def send(message: dict):
+        responses.write(json.dumps(message) + "\n")
+        responses.flush()
+
+    config = json.loads(requests.readline())
+
+    try:
+        helpers = {"__builtins__": __builtins__}
+        exec(config["prelude"], helpers)
+        protections = limit_worker(config["memory_mb"])
+    except Exception as e:
+        send({"error": repr(e)})
+        return
+
+    send({"ready": True, **protections})
+
+    for line in requests:
+        request = json.loads(line)
+
+        # The cpu limit is cumulative for the process, so each snippet gets its own budget on top of what was used
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_limit = int(usage.ru_utime + usage.ru_stime) + config["cpu_seconds"] + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, resource.RLIM_INFINITY))
+
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                exec(request["code"], dict(helpers, **request["variables"]))
+        except BaseException as e:
+            # exit() and sys.exit() raise SystemExit, which would otherwise end the worker
+            output.write(repr(e))
+
+        send({"id": request["id"], "output": output.getvalue()})
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,107 @@
-from fastapi import FastAPI
+import os
+import json
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 import carmen_backend
 
-HOST = "0.0.0.0"
-PORT = 8000
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+# Games live in redis so any worker process can serve any case_id
+WORKERS = int(os.getenv("WORKERS", "1"))
 
 class TravelParam(BaseModel):
     case_id: str
     city: str
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Start the python sandbox workers up front so the first agent turn does not wait for them
+    sandbox = None
+    if carmen_backend.ENGINE_MODE == "agent" and carmen_backend.PYTHON_EXECUTION == "sandbox":
+        sandbox = carmen_backend.get_python_sandbox()
+
+    # Keep pre-generated games ready so /new_game is a single redis pop
+    refiller = None
+    if carmen_backend.GAME_POOL_DEPTH > 0:
+        refiller = carmen_backend.start_game_pool_refiller()
+
+    yield
+
+    if refiller is not None:
+        refiller.set()
+
+    if sandbox is not None:
+        sandbox.close()
+
+    # Workers share the backend's redis connection pool, release it on shutdown
+    await carmen_backend.aclose_redis_connections()
+    carmen_backend.close_redis_connections()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def timing_headers(request: Request, call_next):
+    # Backend spans recorded while serving this request are summed per kind into the Server-Timing header
+    spans = carmen_backend.start_request_spans()
+    start = time.perf_counter()
+
+    response = await call_next(request)
+
+    # Streaming responses only include the time until the first byte
+    duration = time.perf_counter() - start
+    # Labelled by route template so the number of series stays bounded whatever urls are requested
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    carmen_backend.metrics.observe("carmen_http_request_seconds", duration, method=request.method, path=path, status=response.status_code)
+    response.headers["Server-Timing"] = carmen_backend.format_server_timing(spans, duration)
+
+    return response
+
+@app.get("/metrics", summary="Prometheus metrics", description="Request, redis, llm, tool and retry latencies along with token and cost counters per model in the prometheus text format")
+async def metrics():
+    return PlainTextResponse(carmen_backend.metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.post("/new_game", summary="Starts a new game")
-def new_game():
-    return carmen_backend.new_game()
+async def new_game():
+    return await carmen_backend.anew_game()
 
 @app.get("/get_destinations", summary="Gets the next set of destinations", description="Gets the possible destinations to travel to next to solve the case specified by case_id")
-def get_destinations(case_id: str):
-    return carmen_backend.get_destinations(case_id)
+async def get_destinations(case_id: str):
+    return await carmen_backend.aget_destinations(case_id)
 
 @app.get("/get_clues", summary="Get clues for the next destination to travel to", description="Get clues for the next destination to travel to in the case specified by case_id")
-def get_clues(case_id: str):
-    return carmen_backend.get_clues(case_id)
+async def get_clues(case_id: str):
+    return await carmen_backend.aget_clues(case_id)
 
 
 @app.post("/travel", summary="Travel to the specified destination", description="Travel to the specified destination to solve the case for a given case_id")
-def travel(param: TravelParam):
-    return carmen_backend.travel(param.case_id, param.city)
+async def travel(param: TravelParam):
+    return await carmen_backend.atravel(param.case_id, param.city)
+
+async def ndjson_lines(events):
+    try:
+        async for event in events:
+            yield json.dumps(event) + "\n"
+    except Exception as e:
+        # The status code has already been sent, so errors are reported in the stream
+        yield json.dumps({"error": str(e)}) + "\n"
+
+@app.post("/stream/new_game", summary="Starts a new game and streams it", description="Streams the suspect, city and stolen item of a new game as newline delimited json as soon as they are generated, followed by the case_id")
+async def stream_new_game():
+    return StreamingResponse(ndjson_lines(carmen_backend.astream_new_game()), media_type="application/x-ndjson")
+
+@app.get("/stream/get_clues", summary="Streams clues for the next destination to travel to", description="Streams each clue for the case specified by case_id as newline delimited json as soon as it is generated")
+async def stream_clues(case_id: str):
+    return StreamingResponse(ndjson_lines(carmen_backend.astream_clues(case_id)), media_type="application/x-ndjson")
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host=HOST, port=PORT)
+    # Worker processes import the app themselves, which uvicorn only does when given its import string. Importing the
+    # backend takes a few seconds, so workers get longer than the default to answer the supervisor's health checks.
+    uvicorn.run("server:app", host=HOST, port=PORT, workers=WORKERS, timeout_worker_healthcheck=30)